@@ -2,14 +2,14 @@ import logging
 
 from datetime import timedelta
 from psycopg2 import errors as pg_errors
-from flask import Flask, Response
+from flask import Flask, Response, request
 from flask.globals import g
 from flask_jwt_extended import JWTManager
 from pydantic import ValidationError
 from sqlalchemy import exc
 from app.constants import RespMsg, AppError, JwtConfig
 from app.util import resp, JSONProvider, werkzeug_profile
-from util.config import redis_uri, db_uri, dev, config
+from util.config import redis_uri, db_uri, db_replica_uri, dev, config
 from util.database import db, redis_cli
 
 
@@ -32,6 +32,9 @@ g.access_token
 
 g.db_commit
 是否需要在after时提交
+
+g.db_write
+本次请求是否写过，写过之后的语句都走session事务
 '''
 e_code = 500
 
@@ -44,12 +47,16 @@ def init(_app: Flask):
         g.user_id = None
         g.access_token = None
         g.db_commit = False
+        g.db_write = False
 
     @_app.after_request
     def after(response: Response):
-        # 基于请求的自动提交
-        if response.status_code == 200 and g.db_commit:
+        # 基于请求的自动提交，只读请求没有事务，不用提交
+        commit = response.status_code == 200 and g.db_commit
+        if commit:
             db.session.commit()
+            db.stick()
+        db.count_commit(request.endpoint, commit)
         return response
 
     @_app.errorhandler(Exception)
@@ -75,6 +82,8 @@ def create_app() -> Flask:
     _app = Flask(__name__)
     _app.config['REDIS_URL'] = redis_uri
     _app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
+    if db_replica_uri:
+        _app.config['SQLALCHEMY_BINDS'] = {'replica': db_replica_uri}
     _app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     _app.config['SQLALCHEMY_POOL_SIZE'] = 100  # 连接池大小
     # _app.config['SQLALCHEMY_COMMIT_ON_TEARDOWN'] = True  # flask2.3被移除
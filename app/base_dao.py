@@ -1,7 +1,8 @@
 from datetime import datetime
-from functools import partial
-from typing import Callable, Any, Union
+from functools import partial, wraps
+from typing import Callable, Any, Union, Optional, List, Dict
 from uuid import UUID
+from pydantic import BaseModel, TypeAdapter
 from sqlalchemy import Row
 from util.database import db
 
@@ -46,27 +47,106 @@ def build_model(t, keys, struct) -> Any:
     return t(**dict(zip(keys, struct[0] if isinstance(struct, list) else struct)))
 
 
-def wrap(self, f: Callable, *args, **kwargs) -> Any:
-    """装饰器，如果dao方法声明了返回值，则按照返回值格式化"""
-    if ret := getattr(f, '__annotations__').get('return', None):
-        resp = f(self, *args, **kwargs)
-        model, entry = resp
-        return build_model(ret, model, entry)
+def trusted(f: Callable) -> Callable:
+    """
+    声明dao方法返回的行可信，跳过pydantic校验直接model_construct
+    只用在字段类型和数据库返回类型完全一致的模型上，依赖校验做类型转换（比如数组转元组）的不要用
+    """
+    f.__trusted__ = True
+    return f
+
+
+def replica(f: Callable) -> Callable:
+    """
+    声明只读方法可以走从库，用户写过之后的粘滞期内仍走主库
+    读完马上要写、或者对延迟敏感的方法不要用
+    结果要写进共享缓存的也不要用，粘滞只对写的用户生效，别人在失效后马上回填会把从库的旧数据缓存一整个过期时间
+    """
+    @wraps(f)
+    def decorator(*args, **kwargs):
+        with db.replica():
+            return f(*args, **kwargs)
+    return decorator
+
+
+def _model_mapper(t, trusted_: bool) -> Callable[[tuple, Any], Any]:
+    """单行 -> 模型"""
+    if trusted_:
+        return lambda keys, row: t.model_construct(**dict(zip(keys, row)))
+    return lambda keys, row: t(**dict(zip(keys, row)))
+
+
+def _list_mapper(t, trusted_: bool) -> Callable[[tuple, Any], Any]:
+    """多行 -> 列表"""
+    if t in _ele:
+        return lambda keys, rows: list(rows)
+    if not (isinstance(t, type) and issubclass(t, BaseModel)):
+        return lambda keys, rows: [build_model(t, keys, i) for i in rows]
+    if trusted_:
+        construct = t.model_construct
+        return lambda keys, rows: [construct(**dict(zip(keys, i))) for i in rows]
+    # 重写了__init__的模型（比如OpenFlag的匿名遮罩）只能逐个调用构造函数
+    if t.__init__ is not BaseModel.__init__:
+        return lambda keys, rows: [t(**dict(zip(keys, i))) for i in rows]
+    adapter = TypeAdapter(List[t])
+    return lambda keys, rows: adapter.validate_python([dict(zip(keys, i)) for i in rows])
+
+
+def compile_mapper(t, trusted_: bool = False) -> Callable[[tuple, Any], Any]:
+    """按返回值声明预先生成结果映射，规则和build_model一致"""
+    type_ = getattr(t, '__origin__', None)
+    if type_ is list:
+        return _list_mapper(t.__args__[0], trusted_)
+    elif type_ is tuple:
+        return lambda keys, rows: rows[0]
+    elif type_ is Union:
+        inner = compile_mapper(t.__args__[0], trusted_)
+        if type(None) in t.__args__:
+            return lambda keys, rows: inner(keys, rows) if rows else None
+        return inner
+    elif type_ is not None:
+        return lambda keys, rows: build_model(t, keys, rows)
+    if t in _ele:
+        return lambda keys, rows: rows[0][0]
+    row = _model_mapper(t, trusted_)
+    return lambda keys, rows: row(keys, rows[0])
+
+
+def wrap(self, f: Callable, mapper: Optional[Callable], *args, **kwargs) -> Any:
+    """装饰器，如果dao方法声明了返回值，则按照预先生成的映射格式化"""
+    if mapper is not None:
+        keys, entry = f(self, *args, **kwargs)
+        return mapper(tuple(keys), entry)
     f(self, *args, **kwargs)
     return None
 
 
 class Dao:
+    # 方法名 -> 结果映射，类创建时生成
+    __mappers__: Dict[str, Optional[Callable]] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.__mappers__ = {}
+        for k, v in cls.__dict__.items():
+            if not k.startswith('__') and isinstance(v, Callable):
+                ret = getattr(v, '__annotations__', {}).get('return', None)
+                cls.__mappers__[k] = None if ret is None else compile_mapper(ret, getattr(v, '__trusted__', False))
 
     def __init__(self):
         for k, v in type(self).__dict__.items():
             if not k.startswith('__') and isinstance(v, Callable):
-                setattr(self, k, partial(wrap, self, getattr(type(self), k)))
+                setattr(self, k, partial(wrap, self, getattr(type(self), k), type(self).__mappers__.get(k)))
 
     @staticmethod
     def execute(sql: str, **kwargs) -> Any:
         return db.execute(sql, **kwargs)
 
+    @staticmethod
+    def execute_prepared(sql: str, **kwargs) -> Any:
+        """热点查询走服务端预编译，sql里不要拼接变量"""
+        return db.execute_prepared(sql, **kwargs)
+
     @staticmethod
     def text(sql: str, **kwargs) -> str:
         """打印下sql debug用"""
@@ -1,5 +1,6 @@
 import os
 from enum import Enum
+from math import cos, radians
 
 from flask import g
 
@@ -67,6 +68,15 @@ def point(location: Tuple[float, float]):
     return f'SRID=4326;point ({location[1]} {location[0]})'
 
 
+def envelope(location: Tuple[float, float], distance: float) -> Tuple[float, float, float, float]:
+    """圆形范围的外接矩形，用于走gist索引的粗筛，返回xmin, ymin, xmax, ymax"""
+    lat, lon = location
+    d_lat = distance / 111320
+    # 高纬度经度跨度会很大，限制一下
+    d_lon = distance / (111320 * max(cos(radians(lat)), 0.01))
+    return max(lon - d_lon, -180), max(lat - d_lat, -90), min(lon + d_lon, 180), min(lat + d_lat, 90)
+
+
 if __name__ == '__main__':
     from pydantic import BaseModel
 
@@ -23,8 +23,18 @@ class CacheTimeout:
     region_flag = 1800
     # 标记信息
     flag_info = 120
+    # 标记公共数据，点赞数由slave异步刷新，这里只靠过期
+    flag_open = 60
+    # 标记点赞用户集合，每次点赞续期
+    flag_like = 86400
     # app点亮
     app_illuminate = 180
+    # 地图瓦片，详细瓦片写操作会主动失效，这里兜底过期的临时标记；聚合瓦片只靠过期
+    flag_tile = 600
+    # 地图瓦片的cdn缓存
+    flag_tile_cdn = 60
+    # 详细地图检索的公共结果，写操作失效标记附近的分区
+    flag_map = 30
 
 
 class InEnumMeta(EnumMeta):
@@ -67,6 +77,42 @@ class FlagNum:
     senior_user = 1000
 
 
+class MapConfig:
+    """地图检索"""
+    # 详细标记单次返回上限
+    detail_limit = 2000
+    # 小于该距离返回详细标记
+    detail_distance = 10000
+    # 小于该距离返回网格聚合，再往上是区县聚合
+    cluster_distance = 40000
+    # 网格聚合时检索直径切分的格子数
+    cluster_grid = 16
+    # 每个网格返回的代表标记数
+    cluster_sample = 3
+    # 视窗检索时，缩放级别不小于该值返回详细标记
+    viewport_detail_zoom = 13
+    # 没传缩放级别的旧客户端按视窗跨度判断，经纬度跨度都不超过该值（度）才返回详细标记
+    viewport_detail_span = 0.2
+    # 矢量瓦片最大缩放级别
+    tile_max_zoom = 18
+    # 缩放级别小于该值的瓦片返回网格聚合，写操作不主动失效，等过期
+    tile_min_zoom = 10
+    # 聚合瓦片每边切分的格子数
+    tile_cluster_grid = 64
+    # 详细检索结果缓存，定位吸附的网格边长占检索半径桶的比例，越小越精确、命中越低
+    map_cache_cell = 0.125
+    # 检索半径桶的下限，米
+    map_cache_min_radius = 256
+    # 检索半径桶的上限，要不小于详细检索放大后的最大半径，超出的不走缓存
+    map_cache_max_radius = 65536
+    # 每个网格缓存的标记数上限，吸附后的范围比实际检索大，所以比detail_limit大，超出的网格直接按真实定位查
+    map_cache_limit = 8000
+    # 增量同步时token往前多查的秒数，防止并发事务提交晚于token导致漏数据
+    sync_overlap = 5
+    # 删除日志保留天数，token早于这个时间需要全量刷新
+    sync_retention = 7
+
+
 class UserClass:
     signing_out = -2
     block = -1
@@ -185,6 +231,11 @@ class RespMsg:
         'en': 'params error',
         'code': -254
     })
+    system_busy = RespMessage({
+        'zh': '系统繁忙，请稍后再试',
+        'en': 'system busy, please try again later',
+        'code': -247
+    })
     system_error = RespMessage({
         'zh': '系统错误',
         'en': 'server error',
@@ -1,21 +1,27 @@
-import json
 import os
 import logging
-import pickle
+from datetime import timedelta
+from math import radians, asinh, tan, pi
 from typing import List, Tuple, Union, Optional
 from uuid import UUID
 
 from app.message.controller import push_message
 from app.user.dao import dao as user_dao
 from app.flag.dao import dao
-from flask import Blueprint, request, g
+from app.flag.fence import fence_resolver
+from app.flag.like import like_state
+from app.flag.map_cache import map_cache
+from flask import Blueprint, request, g, Response
 from app.constants import flag_picture_size, FileType, RespMsg, CacheTimeout, \
-    StatisticsType, AppError, UserMessageType
+    StatisticsType, AppError, UserMessageType, MapConfig
 from app.flag.typedef import AddFlag, UpdateFlag, SetFlagType, \
-    AddComment, FlagId, GetFlagByMap, GetFlagByFlag, GetFlagByUser, CommentId, FlagSinglePictureDone, Flag, \
-    ChooseIcoName
+    AddComment, FlagId, GetFlagByMap, GetFlagByViewport, GetFlagChanges, GetFlagByFlag, GetFlagByUser, CommentId, \
+    FlagSinglePictureDone, Flag, ChooseIcoName, FlagUpdateInfo, FlagPayload, OpenFlag
+from app.base_typedef import LOCATION
 from app.user.controller import get_user_info
-from app.util import args_parse, resp, custom_jwt, get_request_list, PictureStorageSet, PictureStorage, StatisticsUtil
+from app.util import args_parse, resp, custom_jwt, get_request_list, PictureStorageSet, PictureStorage
+from util.cache import EntityCache, cache_fill
+from util.codec import ModelCodec, msgpack_codec
 from util.database import db, redis_cli
 from util.msg_middleware import mq_flag_like
 from util.up_oss import up_oss
@@ -24,46 +30,128 @@ module_name = os.path.basename(os.path.dirname(__file__))
 bp = Blueprint(module_name, __name__, url_prefix=f'/api/{module_name}')
 
 log = logging.getLogger(__name__)
-statistics_util = StatisticsUtil()
+flag_info_cache = EntityCache('flag-info', CacheTimeout.flag_info, lambda flag_id: dao.get_flag_info(None, flag_id),
+                              codec=ModelCodec(Flag))
 
 # with open(os.path.join(os.path.dirname(__file__), 'location_code.json'), encoding='utf-8') as city_file:
 #     location_code = json.loads(city_file.read())
 
 
 def get_flag_info(flag_id: UUID, refresh: Optional[Flag] = None, user_id: Optional[UUID] = None) -> Flag:
-    # 目前flag表location字段不方便，所以这里先不动态修改缓存
-    key = f'flag-info-{flag_id}'
-    if (value := redis_cli.get(key)) and refresh is not None:
-        return pickle.loads(value)
+    """读缓存，传了user_id则校验标记归属"""
     if refresh is not None:
-        info: Flag = refresh
-    else:
-        info: Flag = dao.get_flag_info(user_id, flag_id)
-    if not info:
+        return flag_info_cache.refresh(flag_id, refresh)
+    info: Flag = flag_info_cache.get(flag_id)
+    if not info or (user_id and info.user_id != user_id):
         raise AppError(RespMsg.flag_not_exist)
-    redis_cli.set(key, pickle.dumps(info), ex=CacheTimeout.flag_info)
     return info
 
 
 def get_region_flag(get: GetFlagByMap) -> Tuple[int, List[dict]]:
     """根据定位位置获取区域内所有的点位"""
-    code = dao.get_city_by_location(get.location) or 0
+    code = fence_resolver.city(get.location)
     if not code:
         return 0, []
-    key = f'region-flag-{get.type}-{code}'
-    # 缓存
-    if value := redis_cli.get(key):
-        return code, json.loads(value)
-    else:
-        value = [f.model_dump() for f in dao.get_flag_by_city(code, get)]
-        redis_cli.set(key, json.dumps(value), ex=CacheTimeout.region_flag)
-        return code, value
+    value = cache_fill(f'region-flag-{get.type}-{code}',
+                       lambda: [f.model_dump() for f in dao.get_flag_by_city(code, get)],
+                       CacheTimeout.region_flag, codec=msgpack_codec)
+    return code, value
+
+
+def tile_key(z: int, x: int, y: int) -> str:
+    return f'flag-tile-{z}-{x}-{y}'
+
+
+def clean_tile(location: LOCATION):
+    """标记变动后，失效详细瓦片各缩放级别下包含该点的瓦片，聚合瓦片范围太大，等过期"""
+    lat, lon = location
+    lat_rad = radians(lat)
+    keys = []
+    for z in range(MapConfig.tile_min_zoom, MapConfig.tile_max_zoom + 1):
+        n = 1 << z
+        x = int((lon + 180) / 360 * n)
+        y = int((1 - asinh(tan(lat_rad)) / pi) / 2 * n)
+        keys.append(tile_key(z, min(max(x, 0), n - 1), min(max(y, 0), n - 1)))
+    redis_cli.delete(*keys)
+
+
+def flag_open_key(flag_id: UUID) -> str:
+    return f'flag-open-{flag_id}'
+
+
+def clean_flag_open(flag_id: UUID):
+    redis_cli.delete(flag_open_key(flag_id))
+
+
+def open_flags(user_id: UUID, flag_ids: List[UUID]) -> List[dict]:
+    """
+    标记的公共数据按id走缓存，所有用户共用
+    是否点赞、收藏以及匿名遮罩这些和查看者相关的部分单独批量查询后再合并
+    """
+    if not flag_ids:
+        return []
+    payloads = {}
+    missing = []
+    for flag_id, value in zip(flag_ids, redis_cli.mget([flag_open_key(i) for i in flag_ids])):
+        if value is None:
+            missing.append(flag_id)
+        else:
+            payloads[flag_id] = FlagPayload.model_validate_json(value)
+    if missing:
+        pipe = redis_cli.pipeline(transaction=False)
+        for p in dao.get_flag_payload(missing):
+            payloads[p.id] = p
+            pipe.set(flag_open_key(p.id), p.model_dump_json(), ex=CacheTimeout.flag_open)
+        pipe.execute()
+    overlay = {o.id: o for o in dao.get_flag_overlay(user_id, flag_ids)}
+    flags = []
+    for flag_id in flag_ids:
+        if (p := payloads.get(flag_id)) is None:
+            continue
+        flag = p.model_dump()
+        if o := overlay.get(flag_id):
+            flag['is_like'], flag['is_fav'] = o.is_like, o.is_fav
+        else:
+            flag['is_like'] = flag['is_fav'] = False
+        # 隐藏或者匿名的标记，别人看不到作者
+        if p.user_id != user_id and (p.hide or p.anonymous):
+            flag['user_id'] = flag['nickname'] = flag['avatar_name'] = None
+        flags.append(flag)
+    # 点赞还没落库，以redis为准
+    return like_state.overlay(user_id, flags)
+
+
+def dump_flags(user_id: UUID, flags: List[OpenFlag]) -> List[dict]:
+    """直接查库的标记列表，点赞还没落库，以redis为准"""
+    return like_state.overlay(user_id, [f.model_dump() for f in flags])
+
+
+def viewport_flags(user_id: UUID, get: GetFlagByViewport) -> List[OpenFlag]:
+    """只是展示可以走从库，增量同步的全量要和主库的token一致，直接调dao"""
+    with db.replica():
+        return dao.get_flag_by_viewport(user_id, get)
+
+
+def update_region_flag(flag_p: FlagUpdateInfo, diff: int = 0):
+    """区县计数器，和标记写操作在同一事务，diff为0时按类型变化调整"""
+    code = flag_p.district_code
+    # 存量数据还没回填
+    if code is None:
+        code = fence_resolver.district(flag_p.location)
+    if not code:
+        return
+    if diff:
+        dao.update_region_flag(code, flag_p.type, diff)
+    elif flag_p.old_type is not None and flag_p.old_type != flag_p.type:
+        dao.update_region_flag(code, flag_p.old_type, -1)
+        dao.update_region_flag(code, flag_p.type, 1)
 
 
 def set_statistics(user_id: UUID, flag_id: UUID, key: str, num: int):
-    """异步点赞"""
-    mq_flag_like.put(f'{user_id}|{flag_id}|{key}|{num}')
-    return resp(RespMsg.success)
+    """异步点赞，发布队列满了回滚redis里的点赞状态，不然redis和数据库永远对不上"""
+    if not mq_flag_like.put(f'{user_id}|{flag_id}|{key}|{num}'):
+        like_state.toggle(user_id, flag_id, not num)
+        raise AppError(RespMsg.system_busy)
 
 
 @bp.route('/add', methods=['post'])
@@ -77,14 +165,20 @@ def add(flag: AddFlag):
     # 获取用户级别
     user_id = g.user_id
     user_class = get_user_info().user_class
-    code = dao.get_city_by_location(flag.location) or 0
+    code = fence_resolver.city(flag.location)
+    district_code = fence_resolver.district(flag.location)
     # 新建标记
     g.error_resp = RespMsg.flag_cant_cover_others_flag
     with db.auto_commit():
-        get_user_info(user_dao.add_flag(user_id))
-        flag_p = dao.add(user_id, flag, user_class)
+        user = user_dao.add_flag(user_id)
+        flag_p = dao.add(user_id, flag, user_class, code, district_code)
         dao.insert_statistics(flag_p.id)
         dao.update_app_illuminate(code, 1)
+        update_region_flag(flag_p, 1)
+    # 提交之后再写缓存，回滚了缓存里不会留下多加的计数
+    get_user_info(user)
+    clean_tile(flag_p.location)
+    map_cache.bump(flag_p.location, flag_p.type)
     return resp(RespMsg.success, flag_id=flag_p.id)
 
 
@@ -93,8 +187,15 @@ def add(flag: AddFlag):
 @custom_jwt()
 def update(flag: UpdateFlag):
     """更新标记"""
-    flag_p = dao.update(g.user_id, flag)
+    # 先提交再失效缓存，否则并发的读会把旧数据重新放回缓存
+    with db.auto_commit():
+        if flag_p := dao.update(g.user_id, flag):
+            update_region_flag(flag_p)
     if flag_p:
+        clean_tile(flag_p.location)
+        clean_flag_open(flag_p.id)
+        flag_info_cache.invalidate(flag_p.id)
+        map_cache.bump(flag_p.location, *filter(lambda t: t is not None, (flag_p.type, flag_p.old_type)))
         return resp(RespMsg.success, flag_id=flag_p.id, pictures=flag_p.pictures)
     return resp(RespMsg.success)
 
@@ -121,7 +222,7 @@ def single_upload_picture():
     if len(b) > flag_picture_size:
         return resp(RespMsg.too_large, -1)
     storage: PictureStorage = PictureStorage(file.filename, b)
-    redis_cli.sadd(key, pickle.dumps(storage))
+    redis_cli.sadd(key, msgpack_codec.dumps((storage.filename, storage.data)))
     redis_cli.expire(key, 60)
     return resp(RespMsg.success)
 
@@ -149,7 +250,8 @@ def single_upload_picture_done(upload: FlagSinglePictureDone):
     if old_names is None:
         return resp(RespMsg.flag_not_exist)
 
-    pictures: PictureStorageSet = PictureStorageSet({pickle.loads(i) for i in redis_cli.smembers(key)})
+    pictures: PictureStorageSet = PictureStorageSet(
+        {PictureStorage(*msgpack_codec.loads(i)) for i in redis_cli.smembers(key)})
     all_pictures: List[Union[str, PictureStorage]] = []
     for url in upload.file_list:
         filename = url.rsplit('/', 1)[-1]
@@ -168,7 +270,9 @@ def single_upload_picture_done(upload: FlagSinglePictureDone):
     names = [f"{up_oss.random_str()}.{flag_id}.{p.suffix}"
              if isinstance(p, PictureStorage) else p for p in all_pictures]
     # 存表
-    dao.upload_pictures(user_id, flag_id, names)
+    with db.auto_commit():
+        dao.upload_pictures(user_id, flag_id, names)
+    clean_flag_open(flag_id)
     for i in range(len(all_pictures)):
         if isinstance(all_pictures[i], PictureStorage):
             # 上传
@@ -195,7 +299,9 @@ def upload_pictures():
     # 构建名字
     names = [f"{up_oss.random_str()}.{flag_id}.{p.filename.rsplit('.', 1)[1]}" for p in pictures]
     # 存表
-    dao.upload_pictures(user_id, flag_id, names)
+    with db.auto_commit():
+        dao.upload_pictures(user_id, flag_id, names)
+    clean_flag_open(flag_id)
     # 上传
     for i in range(len(pictures)):
         up_oss.upload(FileType.flag_pic, names[i], pictures[i].stream.read())
@@ -207,7 +313,8 @@ def upload_pictures():
 @args_parse(GetFlagByUser)
 @custom_jwt()
 def get_flag_by_user(get: GetFlagByUser):
-    return resp([f.model_dump() for f in dao.get_flag_by_user(get.id, g.user_id, get)])
+    user_id = g.user_id
+    return resp(open_flags(user_id, [f.id for f in dao.get_flag_id_by_user(get.id, user_id, get)]))
 
 
 @bp.route('/get-flag-by-flag', methods=['post'])
@@ -219,6 +326,8 @@ def get_flag_by_flag(get: GetFlagByFlag):
     except ValueError:
         return resp(RespMsg.id_illegal, -1)
     if flag := dao.get_flag_by_flag(g.user_id, get.id):
+        # 点赞还没落库，以redis为准
+        flag.is_like, flag.like_num = like_state.get(g.user_id, flag.id)
         return resp(flag.model_dump())
     return resp(RespMsg.flag_not_exist)
 
@@ -228,26 +337,111 @@ def get_flag_by_flag(get: GetFlagByFlag):
 @custom_jwt()
 def get_flag_by_map(get: GetFlagByMap):
     # 10公里内4倍检索，返回详细标记
-    if get.distance < 10000:
+    if get.distance < MapConfig.detail_distance:
         get.distance *= 4
         return resp({
             'code': None,
             'detail': True,
-            'flags': [f.model_dump() for f in dao.get_flag_by_map(g.user_id, get)]})
-    # 10公里-100公里2.25倍检索，返回以区县层级的嵌套
+            'cluster': False,
+            'flags': open_flags(g.user_id, map_cache.get_flag_ids(g.user_id, get))})
+    # 10公里-40公里2.25倍检索，客户端声明支持时返回网格聚合
+    elif get.cluster and get.distance < MapConfig.cluster_distance:
+        get.distance *= 1.5
+        cell = get.distance * 2 / MapConfig.cluster_grid / 111320
+        return resp({
+            'code': None,
+            'detail': False,
+            'cluster': True,
+            'flags': [f.model_dump() for f in dao.get_flag_cluster(g.user_id, get, cell)]})
+    # 其余到100公里，返回以区县层级的嵌套
     else:
         code, data = get_region_flag(get)
-        return resp({'code': code, 'detail': False, 'flags': data})
+        return resp({'code': code, 'detail': False, 'cluster': False, 'flags': data})
+
+
+@bp.route('/get-flag-by-viewport', methods=['post'])
+@args_parse(GetFlagByViewport)
+@custom_jwt()
+def get_flag_by_viewport(get: GetFlagByViewport):
+    """只返回屏幕视窗内的标记，缩放级别较小或没传缩放级别但视窗太大时返回网格聚合"""
+    xmin, ymin, xmax, ymax = get.envelope
+    if get.zoom is None:
+        detail = max(xmax - xmin, ymax - ymin) <= MapConfig.viewport_detail_span
+    else:
+        detail = get.zoom >= MapConfig.viewport_detail_zoom
+    if detail:
+        return resp({
+            'code': None,
+            'detail': True,
+            'cluster': False,
+            'flags': dump_flags(g.user_id, viewport_flags(g.user_id, get))})
+    cell = max(xmax - xmin, ymax - ymin) / MapConfig.cluster_grid
+    return resp({
+        'code': None,
+        'detail': False,
+        'cluster': True,
+        'flags': [f.model_dump() for f in dao.get_flag_cluster_by_viewport(g.user_id, get, cell)]})
+
+
+@bp.route('/get-flag-changes', methods=['post'])
+@args_parse(GetFlagChanges)
+@custom_jwt()
+def get_flag_changes(get: GetFlagChanges):
+    """
+    视窗增量同步，只返回token之后变动的标记和需要移除的标记id
+    结果达到条数上限时数据不完整，增量的退回全量，全量的不返回token，下次仍然全量
+    """
+    user_id = g.user_id
+    token = dao.sync_token()
+    # 没有token或者删除日志已经清理，全量返回
+    if get.token is not None and get.token >= token - timedelta(days=MapConfig.sync_retention):
+        since = get.token - timedelta(seconds=MapConfig.sync_overlap)
+        if len(flags := dao.get_flag_changes(user_id, get, since)) < MapConfig.detail_limit:
+            return resp({
+                'token': token.isoformat(),
+                'full': False,
+                'flags': dump_flags(user_id, flags),
+                'removed': [f.id for f in dao.get_flag_removed(user_id, get, since)]})
+    flags = dao.get_flag_by_viewport(user_id, get)
+    return resp({
+        'token': token.isoformat() if len(flags) < MapConfig.detail_limit else None,
+        'full': True,
+        'flags': dump_flags(user_id, flags),
+        'removed': []})
 
 
 @bp.route('/set-flag-type', methods=['post'])
 @args_parse(SetFlagType)
 @custom_jwt()
 def set_flag_type(set_: SetFlagType):
-    dao.set_flag_type(g.user_id, set_.id, set_.type)
+    with db.auto_commit():
+        if flag_p := dao.set_flag_type(g.user_id, set_.id, set_.type):
+            update_region_flag(flag_p)
+    if flag_p:
+        clean_tile(flag_p.location)
+        clean_flag_open(flag_p.id)
+        flag_info_cache.invalidate(flag_p.id)
+        map_cache.bump(flag_p.location, *filter(lambda t: t is not None, (flag_p.type, flag_p.old_type)))
     return resp(RespMsg.success)
 
 
+@bp.route('/tile/<int:z>/<int:x>/<int:y>', methods=['get'])
+def tile(z: int, x: int, y: int):
+    """公开标记的矢量瓦片，不区分用户，可以走cdn"""
+    if not 0 <= z <= MapConfig.tile_max_zoom or not 0 <= x < 1 << z or not 0 <= y < 1 << z:
+        return resp(RespMsg.params_error, -1)
+    if z >= MapConfig.tile_min_zoom:
+        loader = lambda: bytes(dao.get_tile(z, x, y))
+    else:
+        # 墨卡托下瓦片边长
+        cell = 40075016.68 / (1 << z) / MapConfig.tile_cluster_grid
+        loader = lambda: bytes(dao.get_tile_cluster(z, x, y, cell))
+    value = cache_fill(tile_key(z, x, y), loader, CacheTimeout.flag_tile, codec=msgpack_codec)
+    response = Response(value, mimetype='application/vnd.mapbox-vector-tile')
+    response.headers['Cache-Control'] = f'public, max-age={CacheTimeout.flag_tile_cdn}'
+    return response
+
+
 @bp.route('/delete', methods=['post'])
 @args_parse(FlagId)
 @custom_jwt()
@@ -259,12 +453,22 @@ def delete(delete_: FlagId):
         if flag_update_info := dao.delete(user_id, delete_.id):
             for p in flag_update_info.pictures:
                 up_oss.delete(FileType.flag_pic, p)
-            code = dao.get_city_by_location(flag_update_info.location) or 0
+            code = flag_update_info.city_code
+            if code is None:
+                code = fence_resolver.city(flag_update_info.location)
             # 删除用户表的计数器
-            get_user_info(user_dao.delete_flag(user_id))
+            user = user_dao.delete_flag(user_id)
             # 删除标记统计表
             dao.delete_statistics(flag_update_info.id)
             dao.update_app_illuminate(code, -1)
+            update_region_flag(flag_update_info, -1)
+    if flag_update_info:
+        get_user_info(user)
+        clean_tile(flag_update_info.location)
+        clean_flag_open(flag_update_info.id)
+        flag_info_cache.invalidate(flag_update_info.id)
+        map_cache.bump(flag_update_info.location, flag_update_info.type)
+        like_state.clean(flag_update_info.id)
     return resp(RespMsg.success)
 
 
@@ -273,7 +477,7 @@ def delete(delete_: FlagId):
 def get_fav():
     """我的收藏"""
     user_id = g.user_id
-    return resp([i.model_dump() for i in dao.get_fav(user_id)])
+    return resp(open_flags(user_id, [f.id for f in dao.get_fav_id(user_id)]))
 
 
 @bp.route('/add-fav', methods=['post'])
@@ -284,7 +488,8 @@ def add_fav(add_: FlagId):
     user_id = g.user_id
     with db.auto_commit():
         if flag_id := dao.add_fav(user_id, add_.id):
-            dao.execute(statistics_util.auto_exec(g.user_id, flag_id, StatisticsType.fav, 1))
+            dao.update_statistics(flag_id, StatisticsType.fav, 1)
+    clean_flag_open(add_.id)
     flag = get_flag_info(add_.id)
     content = f'{get_user_info().nickname} 收藏了您的标记 {flag.name}'
     push_message(user_id, flag.user_id, UserMessageType.fav, content, flag_id=flag.id)
@@ -299,7 +504,8 @@ def delete_fav(delete_: FlagId):
     user_id = g.user_id
     with db.auto_commit():
         if flag_id := dao.delete_fav(user_id, delete_.id):
-            dao.execute(statistics_util.auto_exec(g.user_id, flag_id, StatisticsType.fav, 0))
+            dao.update_statistics(flag_id, StatisticsType.fav, -1)
+    clean_flag_open(delete_.id)
     return resp(RespMsg.success)
 
 
@@ -309,10 +515,11 @@ def delete_fav(delete_: FlagId):
 def add_like(like: FlagId):
     """点赞"""
     user_id = g.user_id
-    is_like = dao.is_like(user_id, like.id)
-    if not is_like:
+    # 先确认标记存在，不存在的id不能写进点赞状态
+    flag = get_flag_info(like.id)
+    # redis原子判断，只有状态变化才投递
+    if like_state.toggle(user_id, like.id, True):
         set_statistics(user_id, like.id, StatisticsType.like, 1)
-        flag = get_flag_info(like.id)
         content = f'{get_user_info().nickname} 点赞了您的标记 {flag.name}'
         push_message(user_id, flag.user_id, UserMessageType.like, content, flag_id=flag.id)
     return resp(RespMsg.success)
@@ -324,8 +531,7 @@ def add_like(like: FlagId):
 def delete_like(delete_: FlagId):
     """取消点赞"""
     user_id = g.user_id
-    is_like = dao.is_like(user_id, delete_.id)
-    if is_like:
+    if like_state.toggle(user_id, delete_.id, False):
         set_statistics(user_id, delete_.id, StatisticsType.like, 0)
     return resp(RespMsg.success)
 
@@ -352,10 +558,12 @@ def add_comment(add_: AddComment):
         # 根评论才计数
         with db.auto_commit():
             if comment_id := dao.add_comment(user_id, add_, distance if add_.show_distance else None):
-                dao.execute(statistics_util.auto_exec(user_id, add_.flag_id, StatisticsType.comment, 1))
-                flag = get_flag_info(add_.flag_id)
-                content = f'{get_user_info().nickname} 评论了您的标记 {flag.name}'
-                push_message(user_id, flag.user_id, UserMessageType.comment, content, flag_id=flag.id)
+                dao.update_statistics(add_.flag_id, StatisticsType.comment, 1)
+        if comment_id:
+            clean_flag_open(add_.flag_id)
+            flag = get_flag_info(add_.flag_id)
+            content = f'{get_user_info().nickname} 评论了您的标记 {flag.name}'
+            push_message(user_id, flag.user_id, UserMessageType.comment, content, flag_id=flag.id)
 
     return resp(RespMsg.success, comment_id=comment_id)
 
@@ -401,19 +609,17 @@ def delete_comment(comment: CommentId):
         delete_ = dao.delete_comment(g.user_id, comment.id)
         # 如果是根评论就删除计数
         if delete_ and delete_.parent_id is None:
-            dao.execute(statistics_util.auto_exec(g.user_id, delete_.flag_id, StatisticsType.comment, 0))
+            dao.update_statistics(delete_.flag_id, StatisticsType.comment, -1)
+    if delete_ and delete_.parent_id is None:
+        clean_flag_open(delete_.flag_id)
     return resp(RespMsg.success)
 
 
 @bp.route('/app-illuminate', methods=['post'])
 @custom_jwt()
 def app_illuminate():
-    key = 'app-illuminate'
-    if illuminate := redis_cli.get(key):
-        illuminate = pickle.loads(illuminate)
-    else:
-        illuminate = [i.model_dump() for i in dao.app_illuminate()]
-        redis_cli.set(key, pickle.dumps(illuminate), ex=CacheTimeout.app_illuminate)
+    illuminate = cache_fill('app-illuminate', lambda: [i.model_dump() for i in dao.app_illuminate()],
+                            CacheTimeout.app_illuminate, codec=msgpack_codec)
     return resp(illuminate)
 
 
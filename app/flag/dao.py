@@ -1,9 +1,13 @@
+from datetime import datetime
 from typing import List, Optional, Any
 from uuid import UUID
-from app.base_dao import Dao
-from app.base_typedef import point, LOCATION
-from app.flag.typedef import GetFlagByMap, CommentResp, UpdateFlag, FlagRegion, OpenFlag, \
-    AddFlag, GetFlagByUser, FlagUpdateInfo, AddComment, DeleteComment, Flag, AppIlluminate
+from app.base_dao import Dao, trusted, replica
+from app.base_typedef import point, envelope, LOCATION
+from app.constants import MapConfig
+from app.util import StatisticsUtil
+from app.flag.typedef import GetFlagByMap, GetFlagByViewport, GetFlagChanges, CommentResp, UpdateFlag, FlagRegion, \
+    OpenFlag, AddFlag, GetFlagByUser, FlagUpdateInfo, AddComment, DeleteComment, Flag, AppIlluminate, FlagCluster, \
+    FlagId, Fence, FlagPayload, FlagOverlay, FlagPoint
 from app.user.typedef import User
 
 
@@ -13,6 +17,16 @@ class FlagDao(Dao):
               'pictures, status, ico_name ')
     not_hide = 'status&1=0 and (dead_line is null or dead_line > now())'
     anonymous = 'status&0b10=0b10'
+    # 地图检索共用：公开或者自己的标记，外接矩形走gist索引
+    map_condition = (f'(({not_hide} and not {anonymous}) or f.user_id=:user_id) and type=:type '
+                     'and f.location && ST_MakeEnvelope(:xmin, :ymin, :xmax, :ymax, 4326) ')
+    map_from = ('from flag f inner join users u on f.user_id=u.id '
+                'inner join flag_statistics s on f.id=s.flag_id '
+                'left join fav on f.id=fav.flag_id and fav.user_id=:user_id ')
+    is_like_field = 'exists(select 1 from flag_like l where l.flag_id=f.id and l.user_id=:user_id) is_like'
+    statistics_columns = {key: f'{key}_num' for key in StatisticsUtil.sync_keys}
+    cluster_select = (f"select count(id) flag_num, {Dao.location('ST_Centroid(ST_Collect(location))', 'location')}, "
+                      f'(array_agg(id))[1:{MapConfig.cluster_sample}] ids from s1 group by grid')
 
     def upload_pictures(self, user_id: UUID, flag_id: UUID, pictures: List[str]):
         sql = 'update flag set pictures=:pictures where id=:flag_id and user_id=:user_id'
@@ -22,22 +36,27 @@ class FlagDao(Dao):
         sql = 'select pictures from flag where id=:flag_id and user_id=:user_id'
         return self.execute(sql, user_id=user_id, flag_id=flag_id)
 
-    def add(self, user_id: UUID, flag: AddFlag, user_class: int) -> Optional[FlagUpdateInfo]:
+    def add(self, user_id: UUID, flag: AddFlag, user_class: int,
+            city_code: int, district_code: int) -> Optional[FlagUpdateInfo]:
         sql = ('insert into flag '
                '(id, user_id, location, name, content, user_class, type, status, create_time, update_time, pictures,'
-               'ico_name, dead_line) '
+               'ico_name, dead_line, city_code, district_code) '
                'values(gen_random_uuid(), :user_id, :location, :name, :content, :user_class, :type, :status, '
-               'current_timestamp, current_timestamp, array[]::text[], :ico_name, :dead_line) '
-               f"returning id, pictures, {Dao.location('location', 'location')}")
+               'current_timestamp, current_timestamp, array[]::text[], :ico_name, :dead_line, '
+               ':city_code, :district_code) '
+               f"returning id, pictures, type, city_code, district_code, {Dao.location('location', 'location')}")
         return self.execute(sql, user_id=user_id, content=flag.content, status=flag.status, name=flag.name,
                             user_class=user_class, location=point(flag.location), type=flag.type,
-                            ico_name=flag.ico_name, dead_line=flag.dead_line)
+                            ico_name=flag.ico_name, dead_line=flag.dead_line,
+                            city_code=city_code, district_code=district_code)
 
     def update(self, user_id: UUID, flag: UpdateFlag) -> Optional[FlagUpdateInfo]:
-        sql = ('update flag set name=:name, content=:content, type=:type, status=:status, '
+        sql = ('update flag f set name=:name, content=:content, type=:type, status=:status, '
                'ico_name=:ico_name, update_time=current_timestamp '
-               'where id=:id and user_id=:user_id '
-               f"returning id, pictures, {Dao.location('location', 'location')}")
+               'from (select id, type from flag where id=:id and user_id=:user_id for update) o '
+               'where f.id=o.id '
+               'returning f.id, f.pictures, f.type, o.type old_type, f.city_code, f.district_code, '
+               f"{Dao.location('f.location', 'location')}")
         return self.execute(sql, id=flag.id, user_id=user_id, name=flag.name, content=flag.content, type=flag.type,
                             status=flag.status, ico_name=flag.ico_name)
 
@@ -49,76 +68,225 @@ class FlagDao(Dao):
     def get_flag_by_flag(self, user_id: UUID, flag_id: UUID) -> Optional[OpenFlag]:
         condition = f'(({self.not_hide} and not {self.anonymous}) or f.user_id=:user_id) '
         sql = (f'select {self.fields}, '
-               f"exist(like_users, '{user_id}') is_like, fav.flag_id is not null is_fav, "
+               f'{self.is_like_field}, fav.flag_id is not null is_fav, '
                f'like_num, fav_num, comment_num '
                f'from flag f inner join flag_statistics s on f.id=s.flag_id '
                f'left join fav on f.id=fav.flag_id and fav.user_id=:user_id '
                f'where f.id=:flag_id and {condition} and s.flag_id=:flag_id')
-        return self.execute(sql, user_id=user_id, flag_id=flag_id)
+        return self.execute_prepared(sql, user_id=user_id, flag_id=flag_id)
 
-    def get_flag_by_user(self, user_id: Optional[UUID], private_id: UUID, get: GetFlagByUser) -> List[OpenFlag]:
+    @trusted
+    def get_flag_id_by_user(self, user_id: Optional[UUID], private_id: UUID, get: GetFlagByUser) -> List[FlagId]:
         if user_id:
             condition = f' ({self.not_hide} and not {self.anonymous} and f.user_id=:user_id) '
         else:
             condition = ' (f.user_id=:private_id) '
-        sql = (f'select {self.fields}, '
-               f"exist(like_users, '{private_id}') is_like, fav.flag_id is not null is_fav, "
-               f'like_num, fav_num, comment_num '
-               f'from flag f inner join flag_statistics s on f.id=s.flag_id '
-               f'left join fav on f.id=fav.flag_id and fav.user_id=:private_id '
-               f'where {condition} order by {get.order_by}')
+        sql = f'select f.id from flag f where {condition} order by {get.order_by}'
         return self.execute(sql, user_id=user_id, private_id=private_id)
 
-    def get_flag_by_map(self, user_id: UUID, get: GetFlagByMap) -> List[OpenFlag]:
-        condition = f'(({self.not_hide} and not {self.anonymous}) or f.user_id=:user_id) '
+    @trusted
+    def get_flag_point_by_map(self, get: GetFlagByMap, limit: int) -> List[FlagPoint]:
+        """公开标记的id和坐标，按距离由近到远，地图检索缓存用"""
+        sql = (f'select f.id, ST_Y(f.location) lat, ST_X(f.location) lon from flag f where {self.map_condition}'
+               '\n-- 外接矩形粗筛后，再按球面距离精确过滤\n'
+               'and ST_DWithin(f.location::geography, ST_GeographyFromText(:location), :distance) '
+               'order by f.location <-> ST_GeomFromEWKT(:location) limit :limit')
+        xmin, ymin, xmax, ymax = envelope(get.location, get.distance)
+        return self.execute_prepared(sql, user_id=None, type=get.type, location=point(get.location),
+                                     distance=get.distance, xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax, limit=limit)
+
+    @replica
+    @trusted
+    def get_own_flag_id_by_map(self, user_id: UUID, get: GetFlagByMap) -> List[FlagId]:
+        """自己的非公开标记，公开的走共享缓存"""
+        sql = ('select f.id from flag f where f.user_id=:user_id and type=:type '
+               f'and not ({self.not_hide} and not {self.anonymous}) '
+               'and ST_DWithin(f.location::geography, ST_GeographyFromText(:location), :distance)')
+        return self.execute_prepared(sql, user_id=user_id, type=get.type, location=point(get.location),
+                                     distance=get.distance)
+
+    def get_flag_payload(self, flag_ids: List[UUID]) -> List[FlagPayload]:
+        """不区分查看者的标记数据"""
         sql = (f'select {self.fields}, u.id user_id, u.nickname, u.avatar_name, '
-               f"exist(like_users, '{user_id}') is_like, fav.flag_id is not null is_fav, "
-               f'like_num, fav_num, comment_num '
-               f'from flag f inner join users u on f.user_id=u.id '
-               f'inner join flag_statistics s on f.id=s.flag_id '
-               f'left join fav on f.id=fav.flag_id and fav.user_id=:user_id '
-               f'where {condition} and type=:type '
-               "and ST_Distance(ST_GeographyFromText(:location), "
-               'ST_GeographyFromText(ST_AsText(f.location)))<:distance')
-        return self.execute(sql, user_id=user_id, type=get.type, location=point(get.location), distance=get.distance)
+               'like_num, fav_num, comment_num '
+               'from flag f inner join users u on f.user_id=u.id '
+               'inner join flag_statistics s on f.id=s.flag_id where f.id=any(:flag_ids)')
+        return self.execute(sql, flag_ids=flag_ids)
+
+    @replica
+    @trusted
+    def get_flag_overlay(self, user_id: UUID, flag_ids: List[UUID]) -> List[FlagOverlay]:
+        """批量查询查看者是否点赞、收藏"""
+        sql = ('select s.flag_id id, exists(select 1 from flag_like l where l.flag_id=s.flag_id '
+               'and l.user_id=:user_id) is_like, fav.flag_id is not null is_fav '
+               'from flag_statistics s left join fav on s.flag_id=fav.flag_id and fav.user_id=:user_id '
+               'where s.flag_id=any(:flag_ids)')
+        return self.execute(sql, user_id=user_id, flag_ids=flag_ids)
+
+    def get_flag_by_viewport(self, user_id: UUID, get: GetFlagByViewport) -> List[OpenFlag]:
+        sql = (f'select {self.fields}, u.id user_id, u.nickname, u.avatar_name, '
+               f'{self.is_like_field}, fav.flag_id is not null is_fav, '
+               f'like_num, fav_num, comment_num {self.map_from}'
+               f'where {self.map_condition} '
+               '\n-- 超出上限时截断的结果要稳定，否则同一视窗每次返回的标记不一样\n'
+               'order by f.create_time desc, f.id limit :limit')
+        xmin, ymin, xmax, ymax = get.envelope
+        return self.execute(sql, user_id=user_id, type=get.type,
+                            xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax, limit=MapConfig.detail_limit)
+
+    @replica
+    def get_flag_cluster(self, user_id: UUID, get: GetFlagByMap, cell: float) -> List[FlagCluster]:
+        """按网格聚合，cell为网格边长（度）"""
+        sql = ('with s1 as (select f.id, f.location, ST_SnapToGrid(f.location, :cell) grid from flag f '
+               f'where {self.map_condition} '
+               'and ST_DWithin(f.location::geography, ST_GeographyFromText(:location), :distance)) '
+               f'{self.cluster_select}')
+        xmin, ymin, xmax, ymax = envelope(get.location, get.distance)
+        return self.execute(sql, user_id=user_id, type=get.type, location=point(get.location), distance=get.distance,
+                            xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax, cell=cell)
+
+    @replica
+    def get_flag_cluster_by_viewport(self, user_id: UUID, get: GetFlagByViewport, cell: float) -> List[FlagCluster]:
+        sql = ('with s1 as (select f.id, f.location, ST_SnapToGrid(f.location, :cell) grid from flag f '
+               f'where {self.map_condition}) {self.cluster_select}')
+        xmin, ymin, xmax, ymax = get.envelope
+        return self.execute(sql, user_id=user_id, type=get.type, xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax, cell=cell)
+
+    def get_tile(self, z: int, x: int, y: int) -> Any:
+        """公开标记的矢量瓦片，每个type一个图层"""
+        sql = ('with bounds as (select ST_TileEnvelope(:z, :x, :y) geom), '
+               'mvt as (select f.id, f.type, f.name, f.ico_name, '
+               'ST_AsMVTGeom(ST_Transform(f.location, 3857), bounds.geom) geom from flag f, bounds '
+               f'where {self.not_hide} and not {self.anonymous} '
+               'and f.location && ST_Transform(bounds.geom, 4326)), '
+               "layers as (select ST_AsMVT(mvt, 'type-' || mvt.type) layer from mvt group by mvt.type) "
+               "select coalesce(string_agg(layer, ''::bytea), ''::bytea) from layers")
+        return self.execute(sql, z=z, x=x, y=y)
+
+    def get_tile_cluster(self, z: int, x: int, y: int, cell: float) -> Any:
+        """低缩放级别的聚合瓦片，每个网格每个type一个点，带标记数，cell为网格边长（墨卡托米）"""
+        sql = ('with bounds as (select ST_TileEnvelope(:z, :x, :y) geom), '
+               's1 as (select f.type, ST_SnapToGrid(ST_Transform(f.location, 3857), :cell) grid from flag f, bounds '
+               f'where {self.not_hide} and not {self.anonymous} '
+               'and f.location && ST_Transform(bounds.geom, 4326)), '
+               'mvt as (select s1.type, count(*) flag_num, ST_AsMVTGeom(s1.grid, bounds.geom) geom from s1, bounds '
+               'group by s1.type, s1.grid, bounds.geom), '
+               "layers as (select ST_AsMVT(mvt, 'type-' || mvt.type) layer from mvt group by mvt.type) "
+               "select coalesce(string_agg(layer, ''::bytea), ''::bytea) from layers")
+        return self.execute(sql, z=z, x=x, y=y, cell=cell)
 
-    def get_city_by_location(self, location: LOCATION) -> Optional[int]:
-        sql = ('select a.code from adcode a inner join fences f on a.adcode=f.adcode '
-               'where a.rank=2 and ST_Contains(f.fence,ST_GeomFromText(:location))')
-        return self.execute(sql, location=point(location))
+    def get_fences(self) -> List[Fence]:
+        """市和区县的电子围栏"""
+        sql = ('select a.code, a.rank, ST_AsHEXEWKB(f.fence) fence from adcode a '
+               'inner join fences f on a.adcode=f.adcode where a.rank in (2, 3)')
+        return self.execute(sql)
+
+    def fence_version(self) -> str:
+        """围栏相关表的写入计数和行数，不读围栏数据，用来判断围栏有没有变"""
+        sql = ("select concat_ws('-', (select sum(n_tup_ins + n_tup_upd + n_tup_del) from pg_stat_user_tables "
+               "where relid in ('adcode'::regclass, 'fences'::regclass)), "
+               '(select count(*) from adcode a inner join fences f on a.adcode=f.adcode where a.rank in (2, 3)))')
+        return self.execute(sql)
 
     def get_flag_by_city(self, code, get: GetFlagByMap) -> List[FlagRegion]:
-        sql = ('with s0 as( '
-               '\n-- 根据所在市查找下属区县\n'
-               'select a.adcode, a.name, a.rank, a.center from adcode a where parent=:code), '
-               's1 as ( '
-               '\n-- 下属区县的电子围栏\n'
-               'select s0.name region_name, center, f.fence from s0 inner join fences f on s0.adcode=f.adcode '
-               'where s0.rank=3 and s0.center is not null) '
-               f"select count(location) flag_num, s1.region_name, {Dao.location('s1.center', 'location')} "
-               'from s1 left join flag f on ST_Contains(s1.fence,f.location) '
-               f'group by s1.region_name, s1.center')
+        sql = ('select coalesce(c.flag_num, 0) flag_num, a.name region_name, '
+               f"{Dao.location('a.center', 'location')} from adcode a "
+               'left join region_flag_count c on a.code=c.code and c.type=:type '
+               '\n-- 根据所在市查找有电子围栏的下属区县\n'
+               'where a.parent=:code and a.rank=3 and a.center is not null '
+               'and exists(select 1 from fences f where f.adcode=a.adcode)')
         return self.execute(sql, code=code, type=get.type)
 
-    def set_flag_type(self, user_id: UUID, flag_id: UUID, flag_type: int):
-        sql = 'update flag set type=:flag_type where id=:flag_id and user_id=:user_id'
-        self.execute(sql, user_id=user_id, flag_id=flag_id, flag_type=flag_type)
+    def update_region_flag(self, code: int, flag_type: int, diff: int):
+        sql = ('insert into region_flag_count (code, type, flag_num, update_time) '
+               'values(:code, :flag_type, :diff, current_timestamp) '
+               'on conflict(code, type) do update set flag_num=region_flag_count.flag_num+excluded.flag_num, '
+               'update_time=current_timestamp')
+        self.execute(sql, code=code, flag_type=flag_type, diff=diff)
+
+    def reconcile_region_flag(self):
+        """按flag表的district_code全量重算区县计数，修正计数器漂移"""
+        sql = ('with s2 as (select district_code code, type, count(id) flag_num from flag '
+               'where district_code!=0 group by district_code, type), '
+               'u as (insert into region_flag_count (code, type, flag_num, update_time) '
+               'select code, type, flag_num, current_timestamp from s2 '
+               'on conflict(code, type) do update set flag_num=excluded.flag_num, update_time=current_timestamp '
+               'where region_flag_count.flag_num!=excluded.flag_num) '
+               'update region_flag_count c set flag_num=0, update_time=current_timestamp '
+               'where c.flag_num!=0 and not exists(select 1 from s2 where s2.code=c.code and s2.type=c.type)')
+        self.execute(sql)
+
+    def backfill_flag_region(self, limit: int) -> int:
+        """回填存量标记的市、区县code，返回本批处理的条数"""
+        sql = ('with t as (select id, location from flag where city_code is null limit :limit '
+               'for update skip locked), '
+               'c as (select t.id, '
+               'coalesce((select a.code from adcode a inner join fences f on a.adcode=f.adcode '
+               'where a.rank=2 and ST_Contains(f.fence, t.location) limit 1), 0) city_code, '
+               'coalesce((select a.code from adcode a inner join fences f on a.adcode=f.adcode '
+               'where a.rank=3 and ST_Contains(f.fence, t.location) limit 1), 0) district_code from t), '
+               'u as (update flag f set city_code=c.city_code, district_code=c.district_code from c '
+               'where f.id=c.id returning f.id) '
+               'select count(id) from u')
+        return self.execute(sql, limit=limit)
+
+    def set_flag_type(self, user_id: UUID, flag_id: UUID, flag_type: int) -> Optional[FlagUpdateInfo]:
+        sql = ('update flag f set type=:flag_type, update_time=current_timestamp '
+               'from (select id, type from flag where id=:flag_id and user_id=:user_id for update) o '
+               'where f.id=o.id '
+               'returning f.id, f.pictures, f.type, o.type old_type, f.city_code, f.district_code, '
+               f"{Dao.location('f.location', 'location')}")
+        return self.execute(sql, user_id=user_id, flag_id=flag_id, flag_type=flag_type)
 
     def delete(self, user_id: UUID, flag_id: UUID) -> Optional[FlagUpdateInfo]:
-        sql = ('delete from flag where user_id=:user_id and id=:flag_id '
-               f"returning id, pictures, {Dao.location('location', 'location')}")
+        sql = ('with d as (delete from flag where user_id=:user_id and id=:flag_id returning *), '
+               '\n-- 记录删除日志，给增量同步用\n'
+               'l as (insert into flag_delete_log (flag_id, location, type, delete_time) '
+               'select id, location, type, current_timestamp from d '
+               'on conflict(flag_id) do update set delete_time=excluded.delete_time) '
+               f"select id, pictures, type, city_code, district_code, {Dao.location('location', 'location')} from d")
         return self.execute(sql, user_id=user_id, flag_id=flag_id)
 
-    def is_like(self, user_id: UUID, flag_id: UUID) -> Optional[bool]:
-        sql = f"select exist(like_users, '{user_id}') from flag_statistics where flag_id=:flag_id"
+    def sync_token(self) -> datetime:
+        sql = 'select localtimestamp'
+        return self.execute(sql)
+
+    def get_flag_changes(self, user_id: UUID, get: GetFlagChanges, since: datetime) -> List[OpenFlag]:
+        """视窗内since之后新增或变动的可见标记"""
+        sql = (f'select {self.fields}, u.id user_id, u.nickname, u.avatar_name, '
+               f'{self.is_like_field}, fav.flag_id is not null is_fav, '
+               f'like_num, fav_num, comment_num {self.map_from}'
+               f'where {self.map_condition} and (f.update_time>:since or s.update_time>:since) limit :limit')
+        xmin, ymin, xmax, ymax = get.envelope
+        return self.execute(sql, user_id=user_id, type=get.type, since=since,
+                            xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax, limit=MapConfig.detail_limit)
+
+    @trusted
+    def get_flag_removed(self, user_id: UUID, get: GetFlagChanges, since: datetime) -> List[FlagId]:
+        """视窗内since之后隐藏、过期、换类型或者删除的标记"""
+        sql = ('select f.id from flag f '
+               'where f.location && ST_MakeEnvelope(:xmin, :ymin, :xmax, :ymax, 4326) '
+               'and (f.update_time>:since or (f.dead_line>:since and f.dead_line<=now())) '
+               f'and not ((({self.not_hide} and not {self.anonymous}) or f.user_id=:user_id) and type=:type) '
+               'union all '
+               'select flag_id id from flag_delete_log '
+               'where location && ST_MakeEnvelope(:xmin, :ymin, :xmax, :ymax, 4326) and delete_time>:since')
+        xmin, ymin, xmax, ymax = get.envelope
+        return self.execute(sql, user_id=user_id, type=get.type, since=since,
+                            xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax)
+
+    def clean_delete_log(self, days: int):
+        sql = "delete from flag_delete_log where delete_time<localtimestamp - make_interval(days => :days)"
+        self.execute(sql, days=days)
+
+    def get_like_users(self, flag_id: UUID) -> Optional[Any]:
+        sql = 'select array_agg(user_id) from flag_like where flag_id=:flag_id'
         return self.execute(sql, flag_id=flag_id)
 
-    def get_fav(self, user_id: UUID) -> List[OpenFlag]:
-        sql = (f'select {self.fields}, '
-               f"exist(like_users, '{user_id}') is_like, true is_fav, "
-               f'like_num, fav_num, comment_num '
-               f'from fav left join flag f on fav.flag_id=f.id '
-               'left join flag_statistics s on fav.flag_id=s.flag_id '
+    @replica
+    @trusted
+    def get_fav_id(self, user_id: UUID) -> List[FlagId]:
+        sql = ('select f.id from fav inner join flag f on fav.flag_id=f.id '
                f'where fav.user_id=:user_id and ({self.not_hide} or f.user_id=:user_id) order by fav.create_time')
         return self.execute(sql, user_id=user_id)
 
@@ -156,11 +324,12 @@ class FlagDao(Dao):
                'on u.id=s1.user_id')
         return self.execute(sql, user_id=user_id, flag_id=flag_id, parent_id=parent_id)
 
+    @replica
     def get_comment(self, user_id: UUID, flag_id: UUID) -> List[CommentResp]:
         sql = ('select u.id=:user_id owner, u.id user_id, u.avatar_name, u.nickname, '
                'c.id, c.like_num, c.content, c.parent_id, c.distance, c.create_time from flag_comment c '
                'inner join users u on c.user_id=u.id where c.flag_id=:flag_id')
-        return self.execute(sql, user_id=user_id, flag_id=flag_id)
+        return self.execute_prepared(sql, user_id=user_id, flag_id=flag_id)
 
     def delete_comment(self, user_id: UUID, comment_id: int) -> Optional[DeleteComment]:
         sql = ('delete from flag_comment where (id=:comment_id or parent_id=:comment_id) and user_id=:user_id '
@@ -172,13 +341,21 @@ class FlagDao(Dao):
         return self.execute(sql, user_id=user_id, flag_id=flag_id)
 
     def insert_statistics(self, flag_id: UUID):
-        sql = ('insert into flag_statistics (flag_id, like_users, update_time) '
-               "values(:flag_id, '', current_timestamp)")
+        sql = 'insert into flag_statistics (flag_id, update_time) values(:flag_id, current_timestamp)'
         self.execute(sql, flag_id=flag_id)
 
+    def update_statistics(self, flag_id: UUID, key: str, diff: int):
+        """同步更新的计数器，key是StatisticsUtil.sync_keys之一，列名从固定的映射里取，不拼接传入的字符串"""
+        if (column := self.statistics_columns.get(key)) is None:
+            raise ValueError(f'illegal statistics key: {key}')
+        sql = (f'update flag_statistics set {column}={column}+:diff, update_time=current_timestamp '
+               'where flag_id=:flag_id')
+        self.execute(sql, flag_id=flag_id, diff=diff)
+
     def delete_statistics(self, flag_id: UUID):
         """flag_id只能是接口返回值，防止接口注入，因为没有限定user_id"""
-        sql = 'delete from flag_statistics where flag_id=:flag_id'
+        sql = ('with l as (delete from flag_like where flag_id=:flag_id) '
+               'delete from flag_statistics where flag_id=:flag_id')
         self.execute(sql, flag_id=flag_id)
 
     def app_illuminate(self) -> List[AppIlluminate]:
@@ -188,8 +365,8 @@ class FlagDao(Dao):
         return self.execute(sql)
 
     def update_app_illuminate(self, code: int, diff: int):
-        sql = f'update app_illuminate set flag_num=flag_num+{diff}, update_time=current_timestamp where code=:code'
-        self.execute(sql, code=code)
+        sql = 'update app_illuminate set flag_num=flag_num+:diff, update_time=current_timestamp where code=:code'
+        self.execute(sql, code=code, diff=diff)
 
 
 dao: FlagDao = FlagDao()
@@ -0,0 +1,92 @@
+r"""
+行政区电子围栏，进程内做点查区，替代每次请求都跑的ST_Contains
+围栏几乎不变，每个worker加载一次到STRtree，定期比对库里围栏表的写入计数，变了就重载
+修改围栏表后也可以调用bump让所有进程在下次检查时重载
+"""
+import logging
+import time
+from threading import Lock
+from typing import Dict, List, Tuple
+from uuid import uuid4
+
+import shapely
+from shapely import STRtree, Point
+
+from app.base_typedef import LOCATION
+from app.flag.dao import dao
+from util.database import redis_cli
+
+log = logging.getLogger(__name__)
+
+
+class FenceResolver:
+    version_key = 'fence-version'
+    # 检查围栏版本的间隔，秒
+    check_interval = 60
+    city_rank = 2
+    district_rank = 3
+
+    def __init__(self):
+        self.lock = Lock()
+        self.version = None
+        self.check_time = 0.0
+        # 围栏可能为空，是否加载过单独记
+        self.loaded = False
+        # rank: (STRtree, codes, 围栏)
+        self.trees: Dict[int, Tuple[STRtree, List[int], list]] = {}
+
+    @classmethod
+    def bump(cls):
+        """修改adcode、fences表之后调用"""
+        redis_cli.set(cls.version_key, uuid4().hex)
+
+    def load(self):
+        start = time.time()
+        groups: Dict[int, Tuple[List[int], list]] = {}
+        for f in dao.get_fences():
+            codes, geoms = groups.setdefault(f.rank, ([], []))
+            codes.append(f.code)
+            geoms.append(shapely.from_wkb(f.fence))
+        trees = {}
+        for rank, (codes, geoms) in groups.items():
+            # prepare之后contains判断快很多
+            shapely.prepare(geoms)
+            trees[rank] = (STRtree(geoms), codes, geoms)
+        self.trees = trees
+        self.loaded = True
+        log.info(f'fence loaded: {sum(len(i[1]) for i in trees.values())}, cost {time.time() - start:.2f}s')
+
+    def check(self):
+        """按间隔检查版本，bump的版本或者库里的围栏版本变化了就重载"""
+        now = time.time()
+        if self.loaded and now - self.check_time < self.check_interval:
+            return
+        with self.lock:
+            if self.loaded and now - self.check_time < self.check_interval:
+                return
+            version = (redis_cli.get(self.version_key), dao.fence_version())
+            if not self.loaded or version != self.version:
+                self.load()
+                self.version = version
+            self.check_time = now
+
+    def resolve(self, rank: int, location: LOCATION) -> int:
+        """返回包含该点的行政区code，不在国内返回0"""
+        self.check()
+        if rank not in self.trees:
+            return 0
+        tree, codes, geoms = self.trees[rank]
+        p = Point(location[1], location[0])
+        for i in tree.query(p):
+            if geoms[i].contains(p):
+                return codes[i]
+        return 0
+
+    def city(self, location: LOCATION) -> int:
+        return self.resolve(self.city_rank, location)
+
+    def district(self, location: LOCATION) -> int:
+        return self.resolve(self.district_rank, location)
+
+
+fence_resolver = FenceResolver()
@@ -0,0 +1,112 @@
+r"""
+点赞状态以redis为准，每个标记一个点赞用户集合
+点赞、取消点赞只有一次redis往返，成功改变状态后才投递mq，由slave的FlagLike.flush批量写回数据库
+"""
+import logging
+from typing import Tuple, List
+from uuid import UUID, uuid4
+
+from app.constants import CacheTimeout
+from app.flag.dao import dao
+from util.database import redis_cli
+
+log = logging.getLogger(__name__)
+
+# 集合不存在返回-1，需要先从数据库加载；否则返回sadd/srem的结果，1表示状态有变化
+_toggle = '''
+if redis.call('exists', KEYS[1]) == 0 then
+    return -1
+end
+redis.call('expire', KEYS[1], ARGV[3])
+if ARGV[2] == '1' then
+    return redis.call('sadd', KEYS[1], ARGV[1])
+end
+return redis.call('srem', KEYS[1], ARGV[1])
+'''
+
+# 临时集合只在正式集合不存在时改名过去，防止覆盖并发加载或者已经变化的状态
+_publish = '''
+if redis.call('exists', KEYS[1]) == 1 then
+    redis.call('del', KEYS[2])
+    return 0
+end
+redis.call('rename', KEYS[2], KEYS[1])
+redis.call('expire', KEYS[1], ARGV[1])
+return 1
+'''
+
+
+class LikeState:
+    # 集合里放一个占位成员，区分没人点赞和没加载
+    placeholder = ''
+    # 加载时每批sadd的个数
+    chunk = 1000
+
+    def __init__(self):
+        self._toggle = None
+        self._publish = None
+
+    @staticmethod
+    def key(flag_id: UUID) -> str:
+        return f'flag-like-{flag_id}'
+
+    def load(self, flag_id: UUID):
+        """从数据库加载点赞用户"""
+        if self._publish is None:
+            self._publish = redis_cli.register_script(_publish)
+        users = [str(i) for i in dao.get_like_users(flag_id) or ()]
+        tmp = f'{self.key(flag_id)}-{uuid4().hex}'
+        pipe = redis_cli.pipeline(transaction=False)
+        pipe.sadd(tmp, self.placeholder)
+        for i in range(0, len(users), self.chunk):
+            pipe.sadd(tmp, *users[i: i + self.chunk])
+        pipe.expire(tmp, 60)
+        pipe.execute()
+        self._publish(keys=[self.key(flag_id), tmp], args=[CacheTimeout.flag_like])
+
+    def toggle(self, user_id: UUID, flag_id: UUID, like: bool) -> bool:
+        """点赞或取消点赞，返回状态是否有变化"""
+        if self._toggle is None:
+            self._toggle = redis_cli.register_script(_toggle)
+        args = [str(user_id), int(like), CacheTimeout.flag_like]
+        if (changed := self._toggle(keys=[self.key(flag_id)], args=args)) == -1:
+            self.load(flag_id)
+            changed = self._toggle(keys=[self.key(flag_id)], args=args)
+        return changed == 1
+
+    def get(self, user_id: UUID, flag_id: UUID) -> Tuple[bool, int]:
+        """是否点赞，点赞数"""
+        key = self.key(flag_id)
+        for _ in range(2):
+            pipe = redis_cli.pipeline(transaction=False)
+            pipe.sismember(key, str(user_id))
+            pipe.scard(key)
+            is_like, num = pipe.execute()
+            if num:
+                return bool(is_like), num - 1
+            self.load(flag_id)
+        return False, 0
+
+    def overlay(self, user_id: UUID, flags: List[dict]) -> List[dict]:
+        """
+        列表接口批量以redis为准覆盖is_like、like_num，一次pipeline
+        集合没加载的标记近期没有点赞变动，保留数据库的值
+        """
+        if not flags:
+            return flags
+        pipe = redis_cli.pipeline(transaction=False)
+        for flag in flags:
+            key = self.key(flag['id'])
+            pipe.sismember(key, str(user_id))
+            pipe.scard(key)
+        result = pipe.execute()
+        for flag, is_like, num in zip(flags, result[::2], result[1::2]):
+            if num:
+                flag['is_like'], flag['like_num'] = bool(is_like), num - 1
+        return flags
+
+    def clean(self, flag_id: UUID):
+        redis_cli.delete(self.key(flag_id))
+
+
+like_state = LikeState()
@@ -0,0 +1,126 @@
+r"""
+详细地图检索的公共结果缓存
+定位吸附到网格中心，检索半径向上取到2的幂，同一(类型, 半径桶, 网格)的用户共用一份公开标记的id和坐标
+吸附后的检索半径再加一个网格边长，保证覆盖原始检索范围，取出后按真实定位精确过滤、排序
+失效按分区：每个半径桶把地图切成不小于检索直径的分区，每个分区一个代数，key里带检索范围覆盖的分区代数
+标记写操作只递增所在分区的代数，其他地方的缓存不受影响，旧缓存不用删自然过期
+"""
+from math import asin, ceil, cos, floor, log2, radians, sin, sqrt
+from typing import List, Tuple
+from uuid import UUID
+
+from app.base_typedef import LOCATION, envelope
+from app.constants import CacheTimeout, MapConfig
+from app.flag.dao import dao
+from app.flag.typedef import GetFlagByMap
+from util.cache import register_stats
+from util.codec import CodecError, msgpack_codec
+from util.database import redis_cli
+
+
+def distance(a: LOCATION, b: LOCATION) -> float:
+    """球面距离，米"""
+    lat1, lon1, lat2, lon2 = map(radians, (*a, *b))
+    h = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371008.8 * asin(sqrt(h))
+
+
+class MapCache:
+    def __init__(self):
+        self.stats = register_stats('flag-map')
+        self.radii = []
+        radius = MapConfig.map_cache_min_radius
+        while radius <= MapConfig.map_cache_max_radius:
+            self.radii.append(radius)
+            radius <<= 1
+
+    @staticmethod
+    def radius(distance_: float) -> int:
+        return max(1 << ceil(log2(max(distance_, 1))), MapConfig.map_cache_min_radius)
+
+    @staticmethod
+    def gen_key(type_: int, radius: int, i: int, j: int) -> str:
+        return f'flag-map-gen-{type_}-{radius}-{i}-{j}'
+
+    @staticmethod
+    def steps(radius: int, i: int) -> Tuple[float, float]:
+        """第i行分区的纬度、经度步长，分区边长是吸附后检索范围的直径"""
+        size = 2 * radius * (1 + MapConfig.map_cache_cell)
+        lat_step = size / 111320
+        return lat_step, size / (111320 * max(cos(radians((i + 0.5) * lat_step)), 0.01))
+
+    def tiles(self, radius: int, snapped: GetFlagByMap) -> List[Tuple[int, int]]:
+        """检索范围外接矩形覆盖的分区"""
+        xmin, ymin, xmax, ymax = envelope(snapped.location, snapped.distance)
+        lat_step, _ = self.steps(radius, 0)
+        tiles = []
+        for i in range(floor(ymin / lat_step), floor(ymax / lat_step) + 1):
+            _, lon_step = self.steps(radius, i)
+            tiles.extend((i, j) for j in range(floor(xmin / lon_step), floor(xmax / lon_step) + 1))
+        return tiles
+
+    def bump(self, location: LOCATION, *types: int):
+        """标记增删改后调用，修改类型时新旧类型都要传"""
+        lat, lon = location
+        pipe = redis_cli.pipeline(transaction=False)
+        for t in set(types):
+            for radius in self.radii:
+                lat_step, _ = self.steps(radius, 0)
+                i = floor(lat / lat_step)
+                _, lon_step = self.steps(radius, i)
+                key = self.gen_key(t, radius, i, floor(lon / lon_step))
+                pipe.incr(key)
+                # 代数比缓存活得久就行，过期后归零时旧代数的缓存早就过期了
+                pipe.expire(key, CacheTimeout.flag_map * 2)
+        pipe.execute()
+
+    @staticmethod
+    def quantize(get: GetFlagByMap, radius: int) -> Tuple[GetFlagByMap, str]:
+        """返回吸附后的检索条件和网格key"""
+        cell = radius * MapConfig.map_cache_cell
+        lat, lon = get.location
+        lat_step = cell / 111320
+        i = floor(lat / lat_step)
+        lat = (i + 0.5) * lat_step
+        lon_step = cell / (111320 * max(cos(radians(lat)), 0.01))
+        j = floor(lon / lon_step)
+        lon = (j + 0.5) * lon_step
+        snapped = get.model_copy(update={'location': (lat, lon), 'distance': radius + cell})
+        return snapped, f'{radius}-{i}-{j}'
+
+    def nearest(self, get: GetFlagByMap) -> List[UUID]:
+        """检索范围内的公开标记，由近到远"""
+        radius = self.radius(get.distance)
+        if radius > MapConfig.map_cache_max_radius:
+            return [p.id for p in dao.get_flag_point_by_map(get, MapConfig.detail_limit)]
+        snapped, cell_key = self.quantize(get, radius)
+        gens = redis_cli.mget([self.gen_key(get.type, radius, *t) for t in self.tiles(radius, snapped)])
+        key = f"flag-map-{get.type}-{cell_key}-{'.'.join((g or b'0').decode() for g in gens)}"
+        try:
+            cached = msgpack_codec.loads(raw) if (raw := redis_cli.get(key)) else None
+        except CodecError:
+            cached = None
+        if cached is None:
+            self.stats.redis_miss += 1
+            points = dao.get_flag_point_by_map(snapped, MapConfig.map_cache_limit)
+            # 超出上限的只记一个标志，缓存的不一定包含真实定位附近的标记
+            cached = [True, []] if len(points) >= MapConfig.map_cache_limit else \
+                [False, [(p.id, p.lat, p.lon) for p in points]]
+            redis_cli.set(key, msgpack_codec.dumps(cached), ex=CacheTimeout.flag_map)
+        else:
+            self.stats.redis_hit += 1
+        truncated, points = cached
+        if truncated:
+            return [p.id for p in dao.get_flag_point_by_map(get, MapConfig.detail_limit)]
+        nearby = [(d, flag_id) for flag_id, lat, lon in points
+                  if (d := distance(get.location, (lat, lon))) <= get.distance]
+        nearby.sort(key=lambda x: x[0])
+        return [flag_id for _, flag_id in nearby[:MapConfig.detail_limit]]
+
+    def get_flag_ids(self, user_id: UUID, get: GetFlagByMap) -> List[UUID]:
+        # 自己的非公开标记不共享，单独查
+        own = [f.id for f in dao.get_own_flag_id_by_map(user_id, get)]
+        return list(dict.fromkeys(own + self.nearest(get)))
+
+
+map_cache = MapCache()
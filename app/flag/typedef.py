@@ -2,8 +2,8 @@ from uuid import UUID
 from datetime import datetime, timedelta
 
 from flask import g
-from pydantic import constr, confloat, conint
-from typing import Optional, List, Any
+from pydantic import constr, confloat, conint, NaiveDatetime
+from typing import Optional, List, Any, Tuple
 from app.base_typedef import LOCATION, Order, OrderField, ICO_NAME, CHECK_ICO_NAME
 from app.constants import UserClass
 from app.user.controller import get_user_info
@@ -97,6 +97,12 @@ class FlagUpdateInfo(Model):
     id: UUID
     pictures: List[str]
     location: LOCATION
+    type: _TYPE
+    # 更新前的类型，只有修改类型的接口返回
+    old_type: Optional[_TYPE] = None
+    # 所属市、区县，存量数据回填前为空
+    city_code: Optional[int] = None
+    district_code: Optional[int] = None
 
 
 class GetFlagByOrderField(OrderField):
@@ -128,6 +134,26 @@ class SetFlagType(FlagType):
 class GetFlagByMap(FlagType):
     location: LOCATION
     distance: confloat(le=100000)
+    # 10-40公里返回网格聚合，老客户端不传仍返回区县
+    cluster: bool = False
+
+
+class GetFlagByViewport(FlagType):
+    """视窗检索，左下和右上两个角点"""
+    left_bottom: LOCATION
+    right_top: LOCATION
+    zoom: Optional[conint(ge=0, le=22)] = None
+
+    @property
+    def envelope(self) -> Tuple[float, float, float, float]:
+        """xmin, ymin, xmax, ymax"""
+        (lat0, lon0), (lat1, lon1) = self.left_bottom, self.right_top
+        return min(lon0, lon1), min(lat0, lat1), max(lon0, lon1), max(lat0, lat1)
+
+
+class GetFlagChanges(GetFlagByViewport):
+    """增量同步，token为上次返回的同步时间，为空则全量，和库里的时间一样不带时区，带时区的直接参数错误"""
+    token: Optional[NaiveDatetime] = None
 
 
 class FlagRegion(Model):
@@ -136,7 +162,14 @@ class FlagRegion(Model):
     location: LOCATION
 
 
-class OpenFlag(Model, FlagMixin):
+class FlagCluster(Model):
+    flag_num: int
+    location: LOCATION
+    ids: List[UUID]
+
+
+class FlagPayload(Model, FlagMixin):
+    """不区分查看者的标记数据，可以跨用户缓存"""
     # 匿名或者删除
     user_id: Optional[UUID] = None
     nickname: Optional[str] = None
@@ -154,14 +187,24 @@ class OpenFlag(Model, FlagMixin):
     pictures: List[str]
     ico_name: ICO_NAME
     dead_line: Optional[datetime]
-    # 相关
-    is_like: bool = False
-    is_fav: bool = False
     # 统计
     like_num: int = 0
     fav_num: int = 0
     comment_num: int = 0
 
+
+class FlagOverlay(Model):
+    """查看者相关的标记数据"""
+    id: UUID
+    is_like: bool = False
+    is_fav: bool = False
+
+
+class OpenFlag(FlagPayload):
+    # 相关
+    is_like: bool = False
+    is_fav: bool = False
+
     def __init__(self, **kwargs):
         # 匿名标记
         super().__init__(**kwargs)
@@ -173,6 +216,13 @@ class FlagId(Model):
     id: UUID
 
 
+class FlagPoint(Model):
+    """地图检索缓存用，只要id和坐标"""
+    id: UUID
+    lat: float
+    lon: float
+
+
 class FlagSinglePictureDone(FlagId):
     file_list: List[str]
 
@@ -211,10 +261,18 @@ class CommentResp(Model):
 
 class FlagStatistics(Model):
     flag_id: Optional[UUID]
-    like_users: Optional[dict]
+    like_num: int
+    fav_num: int
+    comment_num: int
     update_time: datetime
 
 
+class Fence(Model):
+    code: int
+    rank: int
+    fence: str
+
+
 class AppIlluminate(Model):
     code: int
     city: str
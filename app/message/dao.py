@@ -3,6 +3,7 @@ from uuid import UUID
 
 from app.base_dao import Dao
 from app.message.typedef import AskNotice, Message
+from app.util import UserMessage
 
 
 class MessageDao(Dao):
@@ -20,6 +21,19 @@ class MessageDao(Dao):
         self.execute(sql, send_id=send_id, receive_id=receive_id, flag_id=flag_id,
                      extra=extra, type_=type_, content=content)
 
+    def send_messages(self, messages: List[UserMessage], chunk: int = 1000):
+        """批量插入，每chunk条一条语句"""
+        sql = ('insert into message (type, send_id, receive_id, flag_id, extra, content, create_time) '
+               "select type, send_id, receive_id, flag_id, coalesce(extra, ''), content, current_timestamp "
+               'from unnest(cast(:types as int[]), cast(:send_ids as uuid[]), cast(:receive_ids as uuid[]), '
+               'cast(:flag_ids as uuid[]), cast(:extras as text[]), cast(:contents as text[])) '
+               'v(type, send_id, receive_id, flag_id, extra, content)')
+        for i in range(0, len(messages), chunk):
+            batch = messages[i: i + chunk]
+            self.execute(sql, types=[m.type_ for m in batch], send_ids=[m.send_id for m in batch],
+                         receive_ids=[m.receive_id for m in batch], flag_ids=[m.flag_id for m in batch],
+                         extras=[m.extra for m in batch], contents=[m.content for m in batch])
+
     def latest_message_id(self, user_id: UUID) -> Optional[int]:
         sql = 'select max(id) id from message where receive_id=:user_id and create_time>current_timestamp + :expires'
         return self.execute(sql, user_id=user_id, expires=self.expires)
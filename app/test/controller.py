@@ -2,6 +2,8 @@ import os
 from flask import Blueprint, g
 from app.user.dao import dao as user_dao
 from app.util import custom_jwt, resp
+from util.cache import cache_stats
+from util.database import db
 
 module_name = os.path.basename(os.path.dirname(__file__))
 bp = Blueprint(module_name, __name__, url_prefix=f'/api/{module_name}')
@@ -23,3 +25,15 @@ def user_info():
     res = user_dao.self_user_info(user_id)
     print(res)
     return resp(res.model_dump())
+
+
+# 本进程两级缓存的命中统计
+@bp.route('/cache-stats', methods=['get'])
+def get_cache_stats():
+    return resp(cache_stats())
+
+
+# 本进程每个接口提交和跳过提交的次数
+@bp.route('/db-stats', methods=['get'])
+def get_db_stats():
+    return resp(db.commit_stats)
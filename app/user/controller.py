@@ -1,6 +1,5 @@
 import logging
 import os
-import pickle
 import re
 from typing import Optional
 from uuid import UUID
@@ -15,7 +14,9 @@ from app.user.typedef import SignIn, SignUp, UserId, SignWechat, SetUserinfo, Qu
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_jwt_extended import create_access_token
 from util.config import config
-from util.database import db, redis_cli
+from util.cache import EntityCache
+from util.codec import ModelCodec
+from util.database import db
 from util.up_oss import up_oss
 
 module_name = os.path.basename(os.path.dirname(__file__))
@@ -26,21 +27,16 @@ username_pattern = re.compile(r'^[a-zA-Z0-9_-]{4,16}$')
 password_pattern = re.compile(r'.*(?=.{6,16})(?=.*\d)(?=.*[A-Z])(?=.*[a-z]).*$')
 
 log = logging.getLogger(__name__)
+user_info_cache = EntityCache('user-info', CacheTimeout.user_info, dao.get_user_info, codec=ModelCodec(User))
 
 
 def get_user_info(refresh: Optional[User] = None, user_id: Optional[UUID] = None) -> User:
-    # 加一层redis
+    """读缓存，写操作之后把新的用户信息传进refresh"""
     user_id = user_id or g.user_id
-    key = f'user-info-{user_id}'
-    if (value := redis_cli.get(key)) and refresh is not None:
-        return pickle.loads(value)
     if refresh is not None:
-        info: User = refresh
-    else:
-        info: User = dao.get_user_info(user_id)
-    if not info:
+        return user_info_cache.refresh(user_id, refresh)
+    if not (info := user_info_cache.get(user_id)):
         raise AppError(RespMsg.user_not_exist)
-    redis_cli.set(key, pickle.dumps(info), ex=CacheTimeout.user_info)
     return info
 
 
@@ -150,8 +146,10 @@ def upload_avatar():
     old_filename = dao.get_avatar_filename(user_id)
     if old_filename != 'default.png':
         up_oss.delete(FileType.head_pic, old_filename)
-    # 设置数据库，再上传
-    get_user_info(dao.set_avatar_filename(user_id, new_filename))
+    # 设置数据库，提交之后再写缓存，再上传
+    with db.auto_commit():
+        user = dao.set_avatar_filename(user_id, new_filename)
+    get_user_info(user)
     up_oss.upload(FileType.head_pic, new_filename, b)
     return resp(RespMsg.success, avatar_name=new_filename)
 
@@ -164,7 +162,9 @@ def set_userinfo(set_: SetUserinfo):
     info = set_.model_dump()
     if not any(info.values()):
         return resp(RespMsg.success)
-    get_user_info(dao.set_userinfo(g.user_id, info))
+    with db.auto_commit():
+        user = dao.set_userinfo(g.user_id, info)
+    get_user_info(user)
     return resp(RespMsg.success)
 
 
@@ -3,7 +3,7 @@ import string
 from typing import Tuple, Optional, List
 from uuid import UUID
 
-from app.base_dao import Dao
+from app.base_dao import Dao, replica
 from app.user.typedef import User, OtherUser, OverviewUser, SelfUser
 
 # vip_deadline = 'infinity'
@@ -54,12 +54,14 @@ class UserDao(Dao):
         sql = 'delete from follow where fans_id=:fans_id and star_id=:star_id'
         return self.execute(sql, fans_id=fans_id, star_id=star_id)
 
+    @replica
     def follow_star(self, user_id: UUID) -> List[OverviewUser]:
         sql = (f'select {overview_fields} '
                'from follow f inner join users u '
                'on f.star_id=u.id where f.fans_id=:user_id')
         return self.execute(sql, user_id=user_id)
 
+    @replica
     def follow_fans(self, user_id: UUID) -> List[OverviewUser]:
         sql = (f'select {overview_fields} '
                'from follow f inner join users u '
@@ -4,18 +4,16 @@ import logging
 import time
 from datetime import datetime
 from functools import wraps
-from threading import Lock
 from uuid import UUID
 import ujson
 from flask.json.provider import DefaultJSONProvider
 from pydantic import BaseModel
-from typing import Any, Optional, Callable, Union, Set, Dict, Tuple, List
+from typing import Any, Optional, Callable, Union, Set, Dict
 from flask_jwt_extended import verify_jwt_in_request, create_access_token
 from flask_jwt_extended.view_decorators import LocationType
 from werkzeug.middleware.profiler import ProfilerMiddleware
 
 from util.database import redis_cli
-from util.wrappers import thread_lock
 from .base_dao import build_model
 from .constants import RespMessage, JwtConfig, DCSLockError
 from util.config import dev
@@ -205,49 +203,69 @@ class StatisticsType:
 
 
 class StatisticsUtil:
-    lock = Lock()
     sync_keys = (StatisticsType.fav, StatisticsType.comment)
     _async_keys = (StatisticsType.like, )
 
     def __init__(self):
-        self.statistics_cache: Dict[UUID, Dict[str, Tuple[Set[UUID], Set[UUID]]]] = {}
+        self.statistics_cache: Dict[UUID, Dict[str, Dict[UUID, int]]] = {}
 
     def add(self, user_id: UUID, flag_id: UUID, key: str, num: int):
-        # num是0则删除，num是1则新增
+        # num是0则删除，num是1则新增，同一用户只保留最后一次操作，点赞后又取消就是取消
         # 嵌套了好几层，就不用default dict了
         if flag_id not in self.statistics_cache:
             self.statistics_cache[flag_id] = {}
         if key not in self.statistics_cache[flag_id]:
-            self.statistics_cache[flag_id][key] = (set(), set())
-        self.statistics_cache[flag_id][key][num].add(user_id)
-
-    def build_flag_statistics_sql(self) -> List[str]:
-        all_sql = []
+            self.statistics_cache[flag_id][key] = {}
+        self.statistics_cache[flag_id][key][user_id] = num
+
+    # 一条语句完成整批写入，参数都是数组，语句文本固定可以复用执行计划
+    flush_sql = (
+        'with a as (insert into flag_like (flag_id, user_id, update_time) '
+        'select flag_id, user_id, current_timestamp '
+        'from unnest(cast(:add_flag as uuid[]), cast(:add_user as uuid[])) v(flag_id, user_id) '
+        # 标记已经删除的不再插入，否则留下孤儿点赞
+        'where exists(select 1 from flag_statistics s where s.flag_id=v.flag_id) '
+        'on conflict do nothing returning flag_id, 1 diff), '
+        'd as (delete from flag_like l '
+        'using unnest(cast(:del_flag as uuid[]), cast(:del_user as uuid[])) v(flag_id, user_id) '
+        'where l.flag_id=v.flag_id and l.user_id=v.user_id returning l.flag_id, -1 diff), '
+        'c as (select flag_id, sum(like_diff) like_diff, sum(fav_diff) fav_diff, sum(comment_diff) comment_diff '
+        'from (select flag_id, diff like_diff, 0 fav_diff, 0 comment_diff from a '
+        'union all select flag_id, diff, 0, 0 from d '
+        'union all select * from unnest(cast(:flag_ids as uuid[]), cast(:like_diff as int[]), '
+        'cast(:fav_diff as int[]), cast(:comment_diff as int[]))) t group by flag_id), '
+        'u as (update flag_statistics s set like_num=like_num+c.like_diff, fav_num=fav_num+c.fav_diff, '
+        'comment_num=comment_num+c.comment_diff, update_time=current_timestamp '
+        'from c where s.flag_id=c.flag_id returning 1) '
+        'select (select count(*) from a) liked, (select count(*) from d) unliked, (select count(*) from u) flags')
+
+    def build_flag_statistics(self) -> Optional[dict]:
+        """
+        把缓存的增减整理成flush_sql的数组参数并清空缓存，没有变化返回None
+        点赞按flag_like实际插入删除的行数计数，其他计数器直接加减
+        """
+        params = {k: [] for k in ('add_flag', 'add_user', 'del_flag', 'del_user',
+                                  'flag_ids', 'like_diff', 'fav_diff', 'comment_diff')}
         for flag_id, kv in self.statistics_cache.items():
-            loop = []
-            for key, tuples in kv.items():
-                # 剔除共有的user_id
-                del_users, add_users = tuples
-                del_users: Set[UUID] = del_users.difference(add_users)
-                add_users: Set[UUID] = add_users.difference(del_users)
-                if key == StatisticsType.like and del_users:
-                    loop.extend((f"{key}_users = delete({key}_users, '{uuid}')" for uuid in del_users))
-                if key == StatisticsType.like and add_users:
-                    loop.extend((f"{key}_users ['{uuid}']=null" for uuid in add_users))
-                num_diff = len(add_users) - len(del_users)
-                if num_diff:
-                    loop.append(f"{key}_num={key}_num+{num_diff} ")
-            if loop:
-                all_sql.append(f"update flag_statistics set {','.join(loop)}, "
-                               f"update_time=current_timestamp where flag_id='{flag_id}'")
+            diff = {StatisticsType.like: 0, StatisticsType.fav: 0, StatisticsType.comment: 0}
+            for key, users in kv.items():
+                add_users = [u for u, num in users.items() if num]
+                del_users = [u for u, num in users.items() if not num]
+                if key == StatisticsType.like:
+                    params['add_flag'].extend(flag_id for _ in add_users)
+                    params['add_user'].extend(add_users)
+                    params['del_flag'].extend(flag_id for _ in del_users)
+                    params['del_user'].extend(del_users)
+                elif key in diff:
+                    diff[key] = len(add_users) - len(del_users)
+            if any(diff.values()):
+                params['flag_ids'].append(flag_id)
+                for key, num in diff.items():
+                    params[f'{key}_diff'].append(num)
         self.statistics_cache.clear()
-        return all_sql
-
-    @thread_lock(lock)
-    def auto_exec(self, user_id: UUID, flag_id: UUID, key: str, num: int):
-        """同步接口保证事务一致性"""
-        self.add(user_id, flag_id, key, num)
-        return ';'.join(self.build_flag_statistics_sql())
+        if params['add_flag'] or params['del_flag'] or params['flag_ids']:
+            return params
+        return None
 
 
 class UserMessage:
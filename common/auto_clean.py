@@ -11,3 +11,29 @@ class AutoClean:
         with placeholder_app.app_context():
             dao.clean_timeout_message()
             db.session.commit()
+
+    @staticmethod
+    def clean_flag_delete_log():
+        """清理过期的标记删除日志"""
+        from app.flag.dao import dao
+        from app.constants import MapConfig
+        with placeholder_app.app_context():
+            dao.clean_delete_log(MapConfig.sync_retention)
+            db.session.commit()
+
+    @staticmethod
+    def reconcile_region_flag():
+        """校准区县标记计数"""
+        from app.flag.dao import dao
+        with placeholder_app.app_context():
+            dao.reconcile_region_flag()
+            db.session.commit()
+
+    @staticmethod
+    def backfill_flag_region():
+        """回填存量标记的市、区县code，分批提交"""
+        from app.flag.dao import dao
+        with placeholder_app.app_context():
+            while dao.backfill_flag_region(1000):
+                db.session.commit()
+            db.session.commit()
@@ -2,41 +2,116 @@ r"""
 标记延时操作
 """
 import logging
-from threading import Lock
+import time
+from threading import Lock, Thread
+from typing import Optional, Tuple
 from uuid import UUID
 
+from sqlalchemy import exc
+
 from util import db
-from app.base_dao import base_dao
 from app.util import StatisticsUtil
 from common.app_shadow import placeholder_app
 from util.msg_middleware import mq_flag_like
+from util.wal import WriteAheadLog, Backoff
 from util.wrappers import thread_lock
 
 
 log = logging.getLogger(__name__)
 
 
-statistics_util = StatisticsUtil()
-
-
 class FlagLike:
     """
     定期刷新flag_statistics表，此表所有写操作都在这里完成
     num字段可以采用非严格模式，定时跑批更新精确num字段
+    双缓冲：锁内只交换缓冲区，写库在锁外，mq消费线程不会被flush卡住
+    事件先记本地预写日志，缓冲区和日志段一一对应，写库成功才删段，进程挂了重启时回放
     """
+    # 保护缓冲区
     lock = Lock()
-    # 元组0是删除的，元组1是新增的
+    # 同一时刻只有一个flush写库，保证多批之间的先后顺序
+    flush_lock = Lock()
+    # 缓冲的事件数超过这个值不等定时任务，提前flush
+    max_size = 20000
+
+    def __init__(self):
+        self.buffer = StatisticsUtil()
+        self.size = 0
+        self.early = False
+        self.wal = WriteAheadLog('flag-like')
+        self.backoff = Backoff()
+        # 写库失败等待重试的一批：参数、日志段
+        self.pending: Optional[Tuple[Optional[dict], int]] = None
+        self.recover()
 
     @thread_lock(lock)
+    def _add(self, user_id: UUID, flag_id: UUID, key: str, num: int, early: bool = True) -> bool:
+        """@:param early 缓冲区满了是否提前flush，回放时不触发"""
+        self.wal.append(f'{user_id}|{flag_id}|{key}|{num}'.encode())
+        self.buffer.add(user_id, flag_id, key, num)
+        self.size += 1
+        if early and self.size >= self.max_size and not self.early:
+            self.early = True
+            return True
+        return False
+
     def add(self, user_id: UUID, flag_id: UUID, key: str, num: int):
-        return statistics_util.add(user_id, flag_id, key, num)
+        if self._add(user_id, flag_id, key, num):
+            Thread(target=self.flush, name='flag-like-flush', daemon=True).start()
 
     @thread_lock(lock)
+    def swap(self) -> Tuple[StatisticsUtil, int]:
+        buffer, self.buffer = self.buffer, StatisticsUtil()
+        self.size = 0
+        self.early = False
+        return buffer, self.wal.rotate()
+
+    def replay(self, segment: int) -> int:
+        """启动时把日志段里的事件重新放回缓冲区，同时记进当前段"""
+        count = 0
+        for data in self.wal.read(segment):
+            # 和mq回调一致，id保持str
+            user_id, flag_id, key, num = data.decode().split('|')
+            self._add(user_id, flag_id, key, int(num), early=False)
+            count += 1
+        self.wal.sync()
+        return count
+
+    def recover(self):
+        """启动时回放上次进程没写库的事件，点赞按实际插入删除计数，重复回放不会多算"""
+        if old := self.wal.open():
+            count = sum(self.replay(seq) for seq in old)
+            self.wal.drop(*old)
+            log.warning(f'recover flag statistics: segments {len(old)}, events {count}')
+
+    @thread_lock(flush_lock)
     def flush(self):
-        if all_sql := statistics_util.build_flag_statistics_sql():
-            with placeholder_app.app_context():
-                base_dao.execute(';'.join(all_sql))
-                db.session.commit()
+        """上一批写库失败的留着先重试，不和新的事件合并，保证先后顺序"""
+        if not self.backoff.ready():
+            return
+        if self.pending is None:
+            buffer, segment = self.swap()
+            self.pending = buffer.build_flag_statistics(), segment
+        params, segment = self.pending
+        try:
+            if params:
+                start = time.time()
+                with placeholder_app.app_context():
+                    _, ((liked, unliked, flags), ) = db.execute(StatisticsUtil.flush_sql, **params)
+                    db.session.commit()
+                log.info(f'flush flag statistics: like {liked}, unlike {unliked}, flags {flags}, '
+                         f'cost {(time.time() - start) * 1000:.1f}ms')
+            self.wal.drop(segment)
+        except (exc.OperationalError, exc.InterfaceError) as e:
+            # 数据库连不上，退避之后再试
+            log.error(f'flush flag statistics: {e}, retry in {self.backoff.fail():.0f}s')
+            return
+        except Exception as e:
+            # 数据本身有问题，重试也没用，整段隔离
+            self.wal.quarantine(segment)
+            log.exception(e)
+        self.pending = None
+        self.backoff.reset()
 
 
 flag_like = FlagLike()
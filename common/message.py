@@ -1,30 +1,102 @@
-from threading import Lock
-from typing import Set
+import logging
+import time
+from threading import Lock, Thread
+from typing import Optional, Set, Tuple
+from sqlalchemy import exc
 from app.message.dao import dao
 from app.util import UserMessage
 from common.app_shadow import placeholder_app
 from util import db
+from util.codec import msgpack_codec
 from util.msg_middleware import mq_user_msg
+from util.wal import WriteAheadLog, Backoff
 from util.wrappers import thread_lock
 
+log = logging.getLogger(__name__)
+
 
 class UserMsgHandler:
+    """
+    双缓冲：锁内只交换集合，写库在锁外
+    消息先记本地预写日志，写库成功才删段，进程挂了重启时回放
+    """
     lock = Lock()
+    flush_lock = Lock()
+    # 缓冲的消息数超过这个值提前flush
+    max_size = 5000
 
     def __init__(self):
         self.filter: Set[UserMessage] = set()
+        self.early = False
+        self.wal = WriteAheadLog('user-msg')
+        self.backoff = Backoff()
+        # 写库失败等待重试的一批：消息、日志段
+        self.pending: Optional[Tuple[Set[UserMessage], int]] = None
+        self.recover()
 
     @thread_lock(lock)
-    def add(self, msg: UserMessage):
+    def _add(self, msg: UserMessage, early: bool = True) -> bool:
+        """@:param early 缓冲区满了是否提前flush，回放时不触发"""
+        self.wal.append(msgpack_codec.dumps(
+            [msg.send_id, msg.receive_id, msg.flag_id, msg.type_, msg.content, msg.extra]))
         self.filter.add(msg)
+        if early and len(self.filter) >= self.max_size and not self.early:
+            self.early = True
+            return True
+        return False
+
+    def add(self, msg: UserMessage):
+        if self._add(msg):
+            Thread(target=self.flush, name='user-msg-flush', daemon=True).start()
 
     @thread_lock(lock)
+    def swap(self) -> Tuple[Set[UserMessage], int]:
+        messages, self.filter = self.filter, set()
+        self.early = False
+        return messages, self.wal.rotate()
+
+    def replay(self, segment: int) -> int:
+        """启动时把日志段里的消息重新放回缓冲区，同时记进当前段"""
+        count = 0
+        for data in self.wal.read(segment):
+            self._add(UserMessage(*msgpack_codec.loads(data)), early=False)
+            count += 1
+        self.wal.sync()
+        return count
+
+    def recover(self):
+        """启动时回放上次进程没写库的消息，写库和删段之间挂掉的话这一批会重复"""
+        if old := self.wal.open():
+            count = sum(self.replay(seq) for seq in old)
+            self.wal.drop(*old)
+            log.warning(f'recover user message: segments {len(old)}, messages {count}')
+
+    @thread_lock(flush_lock)
     def flush(self):
-        with placeholder_app.app_context():
-            while self.filter:
-                msg = self.filter.pop()
-                dao.send_message(msg.type_, msg.send_id, msg.receive_id, msg.flag_id, msg.extra, msg.content)
-            db.session.commit()
+        """上一批写库失败的留着先重试，不和新的消息合并"""
+        if not self.backoff.ready():
+            return
+        if self.pending is None:
+            self.pending = self.swap()
+        messages, segment = self.pending
+        try:
+            if messages:
+                start = time.time()
+                with placeholder_app.app_context():
+                    dao.send_messages(list(messages))
+                    db.session.commit()
+                log.info(f'flush user message: {len(messages)}, cost {(time.time() - start) * 1000:.1f}ms')
+            self.wal.drop(segment)
+        except (exc.OperationalError, exc.InterfaceError) as e:
+            # 数据库连不上，退避之后再试
+            log.error(f'flush user message: {e}, retry in {self.backoff.fail():.0f}s')
+            return
+        except Exception as e:
+            # 数据本身有问题，重试也没用，整段隔离
+            self.wal.quarantine(segment)
+            log.exception(e)
+        self.pending = None
+        self.backoff.reset()
 
 
 user_msg_handler = UserMsgHandler()
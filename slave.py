@@ -21,12 +21,15 @@ def flush_before_exit(signum, frame):
     user_msg_handler.flush()
 
 
-# 注册定时刷新任务
+# 注册定时刷新任务，缓冲的事件都记了本地预写日志，间隔拉长不怕进程挂掉丢数据
 logging.getLogger('apscheduler.executors.default').setLevel(logging.WARNING)
 scheduler = BackgroundScheduler()
-scheduler.add_job(flag_like.flush, 'interval', seconds=3)
+scheduler.add_job(flag_like.flush, 'interval', seconds=10)
 scheduler.add_job(user_msg_handler.flush, 'interval', seconds=10)
 scheduler.add_job(AutoClean.clean_message, 'cron', hour=1, minute=0)
+scheduler.add_job(AutoClean.clean_flag_delete_log, 'cron', hour=1, minute=10)
+scheduler.add_job(AutoClean.backfill_flag_region, 'cron', hour=1, minute=30)
+scheduler.add_job(AutoClean.reconcile_region_flag, 'cron', hour=2, minute=0)
 scheduler.start()
 
 if __name__ == '__main__':
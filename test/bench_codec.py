@@ -0,0 +1,54 @@
+"""
+缓存编解码对比
+pickle整个pydantic对象 vs msgpack(model_dump)，比较编码、解码耗时和每个key的字节数
+"""
+import pickle
+import time
+from datetime import datetime
+from uuid import uuid4
+
+from app.flag.typedef import Flag, AppIlluminate
+from app.user.typedef import User
+from util.codec import ModelCodec, PickleCodec, msgpack_codec
+
+loop = 20000
+
+
+def samples() -> dict:
+    now = datetime.now()
+    user = User(
+        id=uuid4(), nickname='bench', username='bench', password='pbkdf2:sha256:600000$' + 'x' * 80, phone=None,
+        is_man=True, signature='签名' * 10, avatar_name='default.png', bg_avatar_name=None, flag_num=12,
+        create_time=now, vip_deadline=now, block_deadline=datetime.min, alive_deadline=now, belong=None,
+        local='上海', hidden=False)
+    flag = Flag(
+        id=uuid4(), user_id=uuid4(), location=(31.23, 121.47), name='bench', content='内容' * 100, type=0, status=0,
+        user_class=0, create_time=now, update_time=now, pictures=[f'{uuid4().hex}.jpg' for _ in range(6)],
+        ico_name='1f004', dead_line=None)
+    illuminate = [AppIlluminate(code=310000 + i, city=f'城市{i}', location=(31.23, 121.47), flag_num=i * 100,
+                                update_time=now).model_dump() for i in range(10)]
+    return {'user-info': (user, ModelCodec(User)), 'flag-info': (flag, ModelCodec(Flag)),
+            'app-illuminate': (illuminate, msgpack_codec)}
+
+
+def timeit(func) -> float:
+    start = time.perf_counter()
+    for _ in range(loop):
+        func()
+    return (time.perf_counter() - start) / loop * 1e6
+
+
+def main():
+    pickle_codec = PickleCodec()
+    print(f'{"key":<16}{"codec":<10}{"bytes":>8}{"encode us":>12}{"decode us":>12}')
+    for name, (value, codec) in samples().items():
+        for codec_name, c in (('pickle', pickle_codec), ('msgpack', codec)):
+            raw = c.dumps(value)
+            encode = timeit(lambda: c.dumps(value))
+            decode = timeit(lambda: c.loads(raw))
+            print(f'{name:<16}{codec_name:<10}{len(raw):>8}{encode:>12.2f}{decode:>12.2f}')
+    print(f'pickle protocol {pickle.HIGHEST_PROTOCOL}')
+
+
+if __name__ == '__main__':
+    main()
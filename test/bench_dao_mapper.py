@@ -0,0 +1,48 @@
+"""
+dao结果映射压测
+5000行，对比原来每次调用都解析返回值声明的build_model、预先生成的映射、以及model_construct
+"""
+import time
+from datetime import datetime
+from typing import List
+from uuid import uuid4
+
+from app.base_dao import build_model, compile_mapper
+from app.flag.typedef import FlagPayload, FlagId
+
+rows_num = 5000
+loop = 20
+
+
+def payload_rows() -> tuple:
+    now = datetime.now()
+    keys = ('id', 'user_id', 'location', 'name', 'content', 'user_class', 'type', 'create_time', 'update_time',
+            'dead_line', 'pictures', 'status', 'ico_name', 'nickname', 'avatar_name', 'like_num', 'fav_num',
+            'comment_num')
+    rows = [(uuid4(), uuid4(), [31.23, 121.47], 'bench', 'bench', 0, 0, now, now, None, ['a.jpg', 'b.jpg'], 0,
+             '1f004', 'bench', 'default.png', 10, 2, 3) for _ in range(rows_num)]
+    return keys, rows
+
+
+def timeit(func) -> float:
+    start = time.perf_counter()
+    for _ in range(loop):
+        func()
+    return (time.perf_counter() - start) / loop * 1000
+
+
+def main():
+    keys, rows = payload_rows()
+    id_rows = [(r[0], ) for r in rows]
+    for name, t, data in (('FlagPayload', List[FlagPayload], rows), ('FlagId', List[FlagId], id_rows)):
+        k = ('id', ) if t == List[FlagId] else keys
+        validate = compile_mapper(t)
+        construct = compile_mapper(t, True)
+        print(f'{name} x {rows_num}')
+        print(f'  build_model  {timeit(lambda: build_model(t, k, data)):.1f}ms')
+        print(f'  compiled     {timeit(lambda: validate(k, data)):.1f}ms')
+        print(f'  construct    {timeit(lambda: construct(k, data)):.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+get-flag-by-map检索压测
+在flag_bench模式下造100w标记，对比旧的ST_Distance全表扫描和新的索引检索
+"""
+import random
+import statistics
+import time
+from uuid import uuid4
+
+from flask import g
+from sqlalchemy import text
+
+from util import db
+from util.ddl import d2, d5
+from app.flag.controller import open_flags
+from app.flag.dao import dao
+from app.flag.map_cache import map_cache
+from app.flag.typedef import GetFlagByMap
+from app.base_typedef import point
+from common.app_shadow import placeholder_app
+
+schema = 'flag_bench'
+flag_num = 1000000
+user_num = 10000
+# 造数范围，大致是国内
+lat_range = (20.0, 45.0)
+lon_range = (100.0, 122.0)
+loop = 200
+
+old_sql = (f'select {dao.fields}, u.id user_id, u.nickname, u.avatar_name, '
+           "exist(like_users, :user_id) is_like, fav.flag_id is not null is_fav, "
+           'like_num, fav_num, comment_num '
+           'from flag f inner join users u on f.user_id=u.id '
+           'inner join flag_statistics s on f.id=s.flag_id '
+           'left join fav on f.id=fav.flag_id and fav.user_id=:user_id '
+           f'where (({dao.not_hide} and not {dao.anonymous}) or f.user_id=:user_id) and type=:type '
+           "and ST_Distance(ST_GeographyFromText(:location), "
+           'ST_GeographyFromText(ST_AsText(f.location)))<:distance')
+
+
+def seed():
+    db.session.execute(text(f'drop schema if exists {schema} cascade; create schema {schema}'))
+    db.session.execute(text(f'set search_path to {schema}, public'))
+    db.session.execute(text(d2))
+    db.session.execute(text(d5))
+    db.session.execute(text(
+        "create table flag_statistics(flag_id uuid not null primary key, like_users hstore not null default '', "
+        'like_num int not null default 0, fav_num int not null default 0, comment_num int not null default 0, '
+        'update_time timestamp not null)'))
+    db.session.execute(text(
+        'create table fav (id serial primary key, user_id uuid not null, flag_id uuid not null, '
+        'create_time timestamp not null, unique(user_id, flag_id))'))
+    db.session.execute(text(
+        "insert into users (id, nickname, create_time, vip_deadline, block_deadline, alive_deadline, avatar_name) "
+        "select gen_random_uuid(), 'bench-' || i, now(), now(), '-infinity', now(), 'default.png' "
+        'from generate_series(1, :num) i'), {'num': user_num})
+    db.session.execute(text(
+        'with u as (select id, row_number() over () rn from users) '
+        'insert into flag (id, user_id, location, name, content, type, status, user_class, create_time, '
+        'update_time, pictures, ico_name) '
+        'select gen_random_uuid(), u.id, '
+        'ST_SetSRID(ST_MakePoint(:lon0 + random() * (:lon1 - :lon0), :lat0 + random() * (:lat1 - :lat0)), 4326), '
+        "'bench', 'bench', (i % 2), 0, 0, now(), now(), array[]::text[], '' "
+        'from generate_series(1, :num) i inner join u on u.rn = i % :users + 1 '
+        'on conflict do nothing'),
+        {'num': flag_num, 'users': user_num,
+         'lon0': lon_range[0], 'lon1': lon_range[1], 'lat0': lat_range[0], 'lat1': lat_range[1]})
+    db.session.execute(text(
+        'insert into flag_statistics (flag_id, update_time) select id, now() from flag'))
+    db.session.execute(text('analyze'))
+    db.session.commit()
+
+
+def set_search_path():
+    """dao的只读查询走单独的autocommit连接，session和读连接都要设置"""
+    sql = f'set search_path to {schema}, public'
+    db.session.execute(text(sql))
+    db.executor('select 1').execute(text(sql))
+
+
+def timeit(func) -> list:
+    cost = []
+    for _ in range(loop):
+        get = GetFlagByMap(
+            type=0,
+            location=(random.uniform(*lat_range), random.uniform(*lon_range)),
+            distance=random.choice((1000, 4000, 10000, 40000)))
+        start = time.perf_counter()
+        func(get)
+        cost.append((time.perf_counter() - start) * 1000)
+    return cost
+
+
+def report(name: str, cost: list):
+    cost.sort()
+    print(f'{name}: avg {statistics.mean(cost):.1f}ms, p50 {cost[len(cost) // 2]:.1f}ms, '
+          f'p95 {cost[int(len(cost) * 0.95)]:.1f}ms')
+
+
+def main():
+    with placeholder_app.app_context():
+        g.user_id = uuid4()
+        seed()
+        set_search_path()
+        report('old', timeit(lambda get: db.session.execute(text(old_sql), {
+            'user_id': str(g.user_id), 'type': get.type,
+            'location': point(get.location), 'distance': get.distance}).fetchall()))
+        report('new', timeit(lambda get: open_flags(g.user_id, map_cache.get_flag_ids(g.user_id, get))))
+        db.session.rollback()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+点赞风暴下FlagLike.flush压测
+在flag_bench模式下造1w个标记，每轮随机点赞、取消点赞，对比原来拼字符串的多语句和现在的数组参数单语句
+"""
+import random
+import statistics
+import time
+from typing import List
+from uuid import uuid4, UUID
+
+from sqlalchemy import text
+
+from util import db
+from app.util import StatisticsUtil, StatisticsType
+from common.app_shadow import placeholder_app
+
+schema = 'flag_bench'
+flag_num = 10000
+user_num = 5000
+# 每轮点赞事件数
+events = 50000
+loop = 10
+
+
+def seed() -> List[UUID]:
+    db.session.execute(text(f'drop schema if exists {schema} cascade; create schema {schema}'))
+    db.session.execute(text(f'set search_path to {schema}, public'))
+    db.session.execute(text(
+        'create table flag_statistics(flag_id uuid not null primary key, like_num int not null default 0, '
+        'fav_num int not null default 0, comment_num int not null default 0, update_time timestamp not null)'))
+    db.session.execute(text(
+        'create table flag_like (flag_id uuid not null, user_id uuid not null, update_time timestamp not null, '
+        'primary key (flag_id, user_id))'))
+    flag_ids = [uuid4() for _ in range(flag_num)]
+    db.session.execute(text(
+        'insert into flag_statistics (flag_id, update_time) select unnest(cast(:ids as uuid[])), now()'),
+        {'ids': flag_ids})
+    db.session.commit()
+    return flag_ids
+
+
+def old_sql(util: StatisticsUtil) -> List[str]:
+    """原来的写法，uuid拼进字符串，计数器每个标记一条update"""
+    all_sql = []
+    like_add, like_del = [], []
+    for flag_id, kv in util.statistics_cache.items():
+        loop_ = []
+        for key, users in kv.items():
+            add_users = [u for u, num in users.items() if num]
+            del_users = [u for u, num in users.items() if not num]
+            if key == StatisticsType.like:
+                like_add.extend(f"('{flag_id}', '{uuid}')" for uuid in add_users)
+                like_del.extend(f"('{flag_id}', '{uuid}')" for uuid in del_users)
+                continue
+            if num_diff := len(add_users) - len(del_users):
+                loop_.append(f'{key}_num={key}_num+{num_diff} ')
+        if loop_:
+            all_sql.append(f"update flag_statistics set {','.join(loop_)}, "
+                           f"update_time=current_timestamp where flag_id='{flag_id}'")
+    if like_add or like_del:
+        changes = []
+        if like_add:
+            changes.append(f"a as (insert into flag_like (flag_id, user_id, update_time) "
+                           f"select flag_id::uuid, user_id::uuid, current_timestamp from "
+                           f"(values {','.join(like_add)}) v(flag_id, user_id) "
+                           f"on conflict do nothing returning flag_id, 1 diff)")
+        if like_del:
+            changes.append(f"d as (delete from flag_like where (flag_id, user_id) in ({','.join(like_del)}) "
+                           f"returning flag_id, -1 diff)")
+        union = ' union all '.join(f'select flag_id, diff from {c[0]}' for c in changes)
+        all_sql.append(f"with {','.join(changes)}, c as (select flag_id, sum(diff) diff from ({union}) t "
+                       f"group by flag_id) update flag_statistics s set like_num=like_num+c.diff, "
+                       f"update_time=current_timestamp from c where s.flag_id=c.flag_id")
+    util.statistics_cache.clear()
+    return all_sql
+
+
+def storm(util: StatisticsUtil, flag_ids: List[UUID], users: List[UUID]):
+    for _ in range(events):
+        util.add(random.choice(users), random.choice(flag_ids), StatisticsType.like, int(random.random() < 0.8))
+    # 夹杂少量收藏、评论
+    for _ in range(events // 10):
+        util.add(random.choice(users), random.choice(flag_ids), random.choice(StatisticsUtil.sync_keys), 1)
+
+
+def run(name: str, flag_ids: List[UUID], users: List[UUID], flush):
+    cost = []
+    for _ in range(loop):
+        util = StatisticsUtil()
+        storm(util, flag_ids, users)
+        start = time.perf_counter()
+        flush(util)
+        db.session.commit()
+        cost.append((time.perf_counter() - start) * 1000)
+    print(f'{name}: avg {statistics.mean(cost):.1f}ms, max {max(cost):.1f}ms, '
+          f'{events / statistics.mean(cost) * 1000:.0f} events/s')
+
+
+def main():
+    with placeholder_app.app_context():
+        flag_ids = seed()
+        users = [uuid4() for _ in range(user_num)]
+        db.session.execute(text(f'set search_path to {schema}, public'))
+        run('old', flag_ids, users, lambda util: db.session.execute(text(';'.join(old_sql(util)))))
+        run('new', flag_ids, users,
+            lambda util: db.session.execute(text(StatisticsUtil.flush_sql), util.build_flag_statistics()))
+        db.session.execute(text(f'drop schema {schema} cascade'))
+        db.session.commit()
+
+
+if __name__ == '__main__':
+    main()
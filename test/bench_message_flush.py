@@ -0,0 +1,52 @@
+"""
+UserMsgHandler.flush写库压测
+在flag_bench模式下对比逐条send_message和批量send_messages的每秒插入数
+"""
+import random
+import time
+from uuid import uuid4
+
+from sqlalchemy import text
+
+from util import db
+from util.ddl import d8
+from app.message.dao import dao
+from app.util import UserMessage
+from common.app_shadow import placeholder_app
+
+schema = 'flag_bench'
+message_num = 20000
+
+
+def messages() -> list:
+    users = [uuid4() for _ in range(1000)]
+    flag_ids = [uuid4() for _ in range(100)] + [None]
+    return [UserMessage(random.choice(users), random.choice(users), random.choice(flag_ids), random.randint(0, 4),
+                        f'bench {i} 点赞了您的标记', '') for i in range(message_num)]
+
+
+def run(name: str, func):
+    db.session.execute(text('truncate message'))
+    db.session.commit()
+    start = time.perf_counter()
+    func(messages())
+    db.session.commit()
+    cost = time.perf_counter() - start
+    print(f'{name}: {message_num} in {cost:.2f}s, {message_num / cost:.0f} inserts/s')
+
+
+def main():
+    with placeholder_app.app_context():
+        db.session.execute(text(f'drop schema if exists {schema} cascade; create schema {schema}'))
+        db.session.execute(text(f'set search_path to {schema}, public'))
+        db.session.execute(text(d8))
+        db.session.commit()
+        run('send_message', lambda ms: [
+            dao.send_message(m.type_, m.send_id, m.receive_id, m.flag_id, m.extra, m.content) for m in ms])
+        run('send_messages', dao.send_messages)
+        db.session.execute(text(f'drop schema {schema} cascade'))
+        db.session.commit()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+get_user_info、get_flag_info读穿透验证
+冷key查一次库，热key、不存在的id第二次起都不查库
+"""
+from uuid import uuid4
+
+from flask import g
+from sqlalchemy import event, text
+
+from app import app
+from app.user.controller import get_user_info, user_info_cache
+from app.flag.controller import get_flag_info, flag_info_cache
+from app.constants import AppError
+from util import db
+
+
+class QueryCounter:
+    def __init__(self):
+        self.num = 0
+
+    def __call__(self, *args, **kwargs):
+        self.num += 1
+
+
+def count(counter: QueryCounter, func, loop: int = 10) -> int:
+    start = counter.num
+    for _ in range(loop):
+        try:
+            func()
+        except AppError:
+            pass
+    return counter.num - start
+
+
+def check(name: str, num: int, expect: int):
+    print(name, num)
+    assert num == expect, f'{name}: {num} queries, expect {expect}'
+
+
+def main():
+    with app.test_request_context():
+        g.user_id = None
+        counter = QueryCounter()
+        event.listen(db.engine, 'before_cursor_execute', counter)
+        user_id = db.session.execute(text('select id from users limit 1')).scalar()
+        flag_id = db.session.execute(text('select id from flag limit 1')).scalar()
+        missing = uuid4()
+        user_info_cache.invalidate(user_id)
+        flag_info_cache.invalidate(flag_id)
+        user_info_cache.invalidate(missing)
+        flag_info_cache.invalidate(missing)
+
+        check('user cold', count(counter, lambda: get_user_info(user_id=user_id), 1), 1)
+        check('user warm', count(counter, lambda: get_user_info(user_id=user_id)), 0)
+        check('flag cold', count(counter, lambda: get_flag_info(flag_id), 1), 1)
+        check('flag warm', count(counter, lambda: get_flag_info(flag_id)), 0)
+        check('missing user cold', count(counter, lambda: get_user_info(user_id=missing), 1), 1)
+        check('missing user warm', count(counter, lambda: get_user_info(user_id=missing)), 0)
+        check('missing flag cold', count(counter, lambda: get_flag_info(missing), 1), 1)
+        check('missing flag warm', count(counter, lambda: get_flag_info(missing)), 0)
+        print(user_info_cache.stats.to_dict(), flag_info_cache.stats.to_dict())
+        db.session.rollback()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+r"""
+两级缓存，进程内TTLCache在前，redis在后
+进程内这一级只放解码后的对象，命中时不用再访问redis和反序列化
+写入和删除通过redis pub/sub广播，其他进程收到后丢掉自己的本地副本，本地过期时间兜底广播丢失的情况
+"""
+import logging
+import os
+import random
+import struct
+import time
+from math import log as ln
+from threading import Lock, Thread
+from typing import Any, Callable, Dict, Optional, Tuple
+from uuid import uuid4
+
+from cachetools import TTLCache
+
+from util.codec import Codec, CodecError, pickle_codec
+from util.database import redis_cli
+
+log = logging.getLogger(__name__)
+
+# 没有缓存，和缓存了None（不存在）区分开
+MISS = object()
+
+
+class CacheStats:
+    __slots__ = ('local_hit', 'local_miss', 'redis_hit', 'redis_miss')
+
+    def __init__(self):
+        self.local_hit = self.local_miss = self.redis_hit = self.redis_miss = 0
+
+    def to_dict(self) -> dict:
+        local = self.local_hit + self.local_miss
+        remote = self.redis_hit + self.redis_miss
+        return {
+            'local_hit': self.local_hit, 'local_miss': self.local_miss,
+            'local_rate': round(self.local_hit / local, 4) if local else 0,
+            'redis_hit': self.redis_hit, 'redis_miss': self.redis_miss,
+            'redis_rate': round(self.redis_hit / remote, 4) if remote else 0,
+        }
+
+
+# 各缓存的命中统计，/api/test/cache-stats展示
+_stats: Dict[str, CacheStats] = {}
+
+
+def register_stats(name: str) -> CacheStats:
+    return _stats.setdefault(name, CacheStats())
+
+
+class Invalidator:
+    """订阅失效广播，每个worker进程一个线程，第一次用到缓存时才启动，避免fork前起线程"""
+    channel = 'cache-invalidate'
+
+    def __init__(self):
+        self.lock = Lock()
+        self.pid = None
+        # 区分消息是不是自己发的
+        self.origin = uuid4().hex
+        self.caches: Dict[str, 'TwoTierCache'] = {}
+
+    def register(self, cache: 'TwoTierCache'):
+        self.caches[cache.name] = cache
+
+    def ensure(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            # fork出来的进程继承了父进程的本地缓存，全部作废
+            self.origin = uuid4().hex
+            for cache in self.caches.values():
+                cache.local.clear()
+            Thread(target=self.listen, name='cache-invalidate', daemon=True).start()
+            self.pid = os.getpid()
+
+    def publish(self, name: str, key: str):
+        redis_cli.publish(self.channel, f'{self.origin}|{name}|{key}')
+
+    def listen(self):
+        backoff = 0.5
+        while True:
+            try:
+                pubsub = redis_cli.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                backoff = 0.5
+                for message in pubsub.listen():
+                    origin, name, key = message['data'].decode().split('|', 2)
+                    if origin != self.origin and (cache := self.caches.get(name)):
+                        cache.drop(key)
+            except Exception as e:
+                # 断线期间的广播丢了，清空本地缓存
+                log.error(f'cache invalidate: {e}')
+                for cache in self.caches.values():
+                    cache.local.clear()
+                # redis挂了不要空转刷日志
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+
+
+invalidator = Invalidator()
+
+
+class TwoTierCache:
+    """
+    @:param name        缓存名，也是redis key前缀
+    @:param ex          redis过期时间
+    @:param local_ex    本地过期时间，只是广播丢失时的兜底，要短
+    @:param maxsize     本地最多缓存个数，超出按LRU淘汰
+    @:param codec       redis里的编解码
+    """
+
+    def __init__(self, name: str, ex: int, local_ex: int = 5, maxsize: int = 1024, codec: Codec = pickle_codec):
+        self.name = name
+        self.ex = ex
+        self.codec = codec
+        self.lock = Lock()
+        self.local = TTLCache(maxsize, local_ex)
+        self.stats = register_stats(name)
+        invalidator.register(self)
+
+    def key(self, key: Any) -> str:
+        return f'{self.name}-{key}'
+
+    def drop(self, key: str):
+        """只丢掉本地副本"""
+        with self.lock:
+            self.local.pop(key, None)
+
+    def lookup(self, key: Any) -> Any:
+        """没缓存返回MISS，缓存了不存在返回None"""
+        invalidator.ensure()
+        key = str(key)
+        with self.lock:
+            value = self.local.get(key, MISS)
+        if value is not MISS:
+            self.stats.local_hit += 1
+            return value
+        self.stats.local_miss += 1
+        try:
+            raw = redis_cli.get(self.key(key))
+            value = MISS if raw is None else self.codec.loads(raw) if raw else None
+        except CodecError:
+            # 旧格式或者版本不一致的也算没命中
+            value = MISS
+        if value is MISS:
+            self.stats.redis_miss += 1
+            return MISS
+        self.stats.redis_hit += 1
+        with self.lock:
+            self.local[key] = value
+        return value
+
+    def get(self, key: Any) -> Optional[Any]:
+        if (value := self.lookup(key)) is MISS:
+            return None
+        return value
+
+    def set(self, key: Any, value: Any, ex: Optional[int] = None, publish: bool = True):
+        """
+        value为None时缓存一个空值，表示不存在
+        @:param publish 是否广播让其他进程丢掉本地副本，只有真正的写才需要
+        """
+        invalidator.ensure()
+        key = str(key)
+        redis_cli.set(self.key(key), b'' if value is None else self.codec.dumps(value), ex=ex or self.ex)
+        with self.lock:
+            self.local[key] = value
+        if publish:
+            invalidator.publish(self.name, key)
+
+    def delete(self, key: Any):
+        invalidator.ensure()
+        key = str(key)
+        redis_cli.delete(self.key(key))
+        self.drop(key)
+        invalidator.publish(self.name, key)
+
+
+class EntityCache(TwoTierCache):
+    """
+    按id缓存的实体，读穿透、写穿透
+    不存在的id也缓存一个空值，防止反复查库
+    本地这一级返回的是共享对象，调用方不要修改
+
+    @:param loader      id -> 实体，不存在返回None
+    @:param negative_ex 空值的过期时间
+    """
+
+    def __init__(self, name: str, ex: int, loader: Callable[[Any], Optional[Any]], negative_ex: int = 30, **kwargs):
+        super().__init__(name, ex, **kwargs)
+        self.loader = loader
+        self.negative_ex = negative_ex
+
+    def get(self, key: Any) -> Optional[Any]:
+        if (value := self.lookup(key)) is MISS:
+            # 没命中只是回填，数据没变，其他进程的本地副本还是对的，不广播
+            value = self.loader(key)
+            self.set(key, value, None if value is not None else self.negative_ex, publish=False)
+        return value
+
+    def refresh(self, key: Any, value: Optional[Any] = None) -> Optional[Any]:
+        """写操作之后调用，传入新值直接写缓存，否则重新查库"""
+        if value is None:
+            value = self.loader(key)
+        self.set(key, value, None if value is not None else self.negative_ex)
+        return value
+
+    def invalidate(self, key: Any):
+        self.delete(key)
+
+
+# 租约里存持有者的token，只删自己的，超时后别人拿到的租约不能误删
+_release = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+'''
+_release_script = None
+
+
+def _release_lease(key: str, token: str):
+    global _release_script
+    if _release_script is None:
+        _release_script = redis_cli.register_script(_release)
+    _release_script(keys=[key], args=[token])
+
+
+# cache_fill写入的头，逻辑过期时间和上次计算耗时
+_fill_magic = b'CF1'
+_fill_header = struct.Struct('!dd')
+
+
+def _fill_pack(value: bytes, ex: int, delta: float) -> bytes:
+    return _fill_magic + _fill_header.pack(time.time() + ex, delta) + value
+
+
+def _fill_unpack(raw: Optional[bytes], codec: Codec) -> Optional[Tuple[float, float, Any]]:
+    if not raw or not raw.startswith(_fill_magic):
+        return None
+    offset = len(_fill_magic)
+    expire_at, delta = _fill_header.unpack_from(raw, offset)
+    try:
+        return expire_at, delta, codec.loads(raw[offset + _fill_header.size:])
+    except CodecError:
+        return None
+
+
+def cache_fill(key: str, loader: Callable[[], Any], ex: int, stale: Optional[int] = None, lease: int = 10,
+               beta: float = 1.0, codec: Codec = pickle_codec) -> Any:
+    """
+    防击穿的读缓存，适合计算很重的key
+    过期前按上次计算耗时提前概率刷新（XFetch），过期后stale时间内仍返回旧值
+    同一时刻只有拿到租约的进程去计算，其他进程返回旧值，没有旧值就等租约释放
+
+    @:param key     redis key
+    @:param loader  计算函数
+    @:param ex      逻辑过期时间
+    @:param stale   过期后还能返回旧值的时间，默认等于ex
+    @:param lease   租约时间，要比loader最长耗时长
+    @:param beta    越大越早刷新
+    @:param codec   编解码
+    """
+    lease_key = f'{key}-lease'
+    old = None
+    if unpacked := _fill_unpack(redis_cli.get(key), codec):
+        expire_at, delta, old = unpacked
+        # -log(random)服从指数分布，临近过期时少数请求提前刷新
+        if time.time() - delta * beta * ln(1 - random.random()) < expire_at:
+            return old
+
+    token = uuid4().hex
+    deadline = time.time() + lease
+    while not (acquired := redis_cli.set(lease_key, token, nx=True, ex=lease)):
+        if old is not None:
+            return old
+        # 冷启动没有旧值，等拿到租约的进程算完
+        time.sleep(0.05)
+        if unpacked := _fill_unpack(redis_cli.get(key), codec):
+            return unpacked[2]
+        # 等太久了自己算，不拿租约
+        if time.time() > deadline:
+            break
+    try:
+        start = time.time()
+        value = loader()
+        raw = _fill_pack(codec.dumps(value), ex, time.time() - start)
+        redis_cli.set(key, raw, ex=ex + (ex if stale is None else stale))
+        return value
+    finally:
+        if acquired:
+            _release_lease(lease_key, token)
+
+
+def cache_stats() -> Dict[str, dict]:
+    return {name: stats.to_dict() for name, stats in _stats.items()}
@@ -0,0 +1,114 @@
+r"""
+缓存编解码，redis里的缓存都通过这里序列化
+pickle保存的是整个pydantic对象，体积大、反序列化慢，模型一改发版期间新旧进程还会互相读坏
+msgpack只保存model_dump的数据，带上版本号，版本对不上当作没有缓存
+"""
+import pickle
+import re
+from datetime import datetime
+from typing import Any, Type
+from uuid import UUID
+from zlib import crc32
+
+import msgpack
+from pydantic import BaseModel, ValidationError
+
+_EXT_DATETIME = 1
+_EXT_UUID = 2
+
+
+class CodecError(ValueError):
+    """解不出来，调用方按没有缓存处理"""
+
+
+def _default(obj: Any):
+    if isinstance(obj, datetime):
+        return msgpack.ExtType(_EXT_DATETIME, obj.isoformat().encode())
+    elif isinstance(obj, UUID):
+        return msgpack.ExtType(_EXT_UUID, obj.bytes)
+    elif isinstance(obj, BaseModel):
+        return obj.model_dump()
+    raise TypeError(f'illegal type: {obj}')
+
+
+def _ext_hook(code: int, data: bytes):
+    if code == _EXT_DATETIME:
+        return datetime.fromisoformat(data.decode())
+    elif code == _EXT_UUID:
+        return UUID(bytes=data)
+    return msgpack.ExtType(code, data)
+
+
+class Codec:
+    def dumps(self, value: Any) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, raw: bytes) -> Any:
+        raise NotImplementedError
+
+
+class PickleCodec(Codec):
+    def dumps(self, value: Any) -> bytes:
+        return pickle.dumps(value)
+
+    def loads(self, raw: bytes) -> Any:
+        try:
+            return pickle.loads(raw)
+        except Exception as e:
+            raise CodecError(e)
+
+
+class MsgpackCodec(Codec):
+    """
+    dict、list等基础类型，另外支持datetime、UUID
+    @:param version 数据结构变了就加1
+    """
+
+    def __init__(self, version: int = 1):
+        self.version = version
+
+    def pack(self, value: Any) -> bytes:
+        return msgpack.packb([self.version, value], default=_default, use_bin_type=True)
+
+    def unpack(self, raw: bytes) -> Any:
+        try:
+            version, value = msgpack.unpackb(raw, ext_hook=_ext_hook, raw=False, strict_map_key=False)
+        except Exception as e:
+            raise CodecError(e)
+        if version != self.version:
+            raise CodecError(f'version {version} != {self.version}')
+        return value
+
+    def dumps(self, value: Any) -> bytes:
+        return self.pack(value)
+
+    def loads(self, raw: bytes) -> Any:
+        return self.unpack(raw)
+
+
+class ModelCodec(MsgpackCodec):
+    """
+    pydantic模型，只存字段值
+    版本号是手动版本加上字段名和类型的校验和，增删字段、改类型不用手动改版本
+    约束之类校验和覆盖不到的变化，校验不过也按没有缓存处理
+    """
+
+    def __init__(self, model: Type[BaseModel], version: int = 1):
+        # 嵌套的Annotated里可能有函数，repr带内存地址，每个进程不一样，要去掉
+        fields = sorted(re.sub(r' at 0x[0-9a-f]+', '', f'{k}:{v.annotation}') for k, v in model.model_fields.items())
+        fingerprint = crc32(','.join(fields).encode())
+        super().__init__(version << 32 | fingerprint)
+        self.model = model
+
+    def dumps(self, value: BaseModel) -> bytes:
+        return self.pack(value.model_dump())
+
+    def loads(self, raw: bytes) -> BaseModel:
+        try:
+            return self.model.model_validate(self.unpack(raw))
+        except ValidationError as e:
+            raise CodecError(e)
+
+
+pickle_codec = PickleCodec()
+msgpack_codec = MsgpackCodec()
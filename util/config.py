@@ -6,14 +6,28 @@ with open(os.path.join(os.path.dirname(__file__), os.pardir, 'config.yaml')) as
 
 redis_uri = f"redis://:{config['redis'][config['env']]['passwd']}@{config['redis'][config['env']]['host']}:6379/0"
 
+db_config = config['db'][config['env']]
 db_uri = 'postgresql://{}:{}@{}:{}/{}'.format(
-        config['db'][config['env']]['user'],
-        config['db'][config['env']]['passwd'],
-        config['db'][config['env']]['host'],
-        config['db'][config['env']]['port'],
-        config['db'][config['env']]['db_name']
+        db_config['user'],
+        db_config['passwd'],
+        db_config['host'],
+        db_config['port'],
+        db_config['db_name']
     )
+# 只读从库，只写和主库不一样的项，比如host、port，不配置则全部走主库
+if replica := db_config.get('replica'):
+    replica = {**db_config, **replica}
+    db_replica_uri = 'postgresql://{}:{}@{}:{}/{}'.format(
+        replica['user'], replica['passwd'], replica['host'], replica['port'], replica['db_name'])
+else:
+    db_replica_uri = None
+# 写过之后多少秒内该用户的读都走主库，从库复制延迟要小于这个值
+db_sticky = config.get('db_sticky', 5)
 dev = config['env'] == 'dev'
+# 服务端预编译语句，连接池是pgbouncer事务模式时要关掉
+db_prepare = config.get('db_prepare', True)
+# slave本地预写日志目录，必须是本机磁盘，多个slave不能共用
+wal_dir = config.get('wal_dir', os.path.join(os.path.dirname(__file__), os.pardir, 'wal'))
 
 up_config = config['up_oss'][config['env']]
 
@@ -1,32 +1,159 @@
 import logging
+import re
+from functools import lru_cache
+from hashlib import md5
 
 from flask import g
 from flask_redis import FlaskRedis
-from sqlalchemy import text
+from sqlalchemy import text, TextClause
 from sqlalchemy.engine.result import RMKeyView
-from typing import Tuple, Any, Optional
+from typing import Tuple, Any, Optional, Dict
 from contextlib import contextmanager
 from flask_sqlalchemy import SQLAlchemy as _SQLAlchemy
+from util.config import db_prepare, db_sticky, db_replica_uri
 
 
 log = logging.getLogger(__name__)
 
+# 和sqlalchemy的text一致，:name是绑定参数，::是类型转换
+_bind = re.compile(r'(?<![:\w\x5c]):(\w+)(?!:)')
+
+
+@lru_cache(maxsize=1024)
+def _text(sql: str) -> TextClause:
+    """同样的sql只解析一次"""
+    return text(sql)
+
+
+@lru_cache(maxsize=256)
+def _prepare(sql: str) -> Tuple[str, TextClause, TextClause]:
+    """
+    绑定参数按出现顺序换成$1、$2，返回语句名、prepare语句、execute语句
+    参数类型交给pg按上下文推断
+    """
+    names = []
+
+    def repl(m: re.Match) -> str:
+        if m.group(1) not in names:
+            names.append(m.group(1))
+        return f'${names.index(m.group(1)) + 1}'
+
+    body = _bind.sub(repl, sql)
+    name = f'p_{md5(sql.encode()).hexdigest()[:16]}'
+    args = f"({', '.join(f':{i}' for i in names)})" if names else ''
+    # prepare语句里不能再有绑定参数，冒号都已经替换掉了
+    return name, text(f'prepare {name} as {body}'.replace(':', r'\:')), text(f'execute {name}{args}')
+
+
+# 写语句的关键字，误判成写只是多一次提交，所以宁可多判
+_write = re.compile(r'\b(insert|update|delete|merge|create|alter|drop|truncate|lock|copy|call|nextval|setval)\b',
+                    re.IGNORECASE)
+
+
+@lru_cache(maxsize=1024)
+def is_write(sql: str) -> bool:
+    return bool(_write.search(sql))
+
 
 class SQLAlchemy(_SQLAlchemy):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 每个接口提交和跳过提交的次数，本进程
+        self.commit_stats: Dict[str, Dict[str, int]] = {}
+
+    def init_app(self, app):
+        super().init_app(app)
+        app.teardown_appcontext(self.close_read)
+
     @contextmanager
     def auto_commit(self):
+        # 事务块里的读也要走同一个事务
+        g.db_write = True
         try:
             yield
             self.session.commit()
-            g.db_commit = False
+            self.stick()
+            g.db_commit = g.db_write = False
         except Exception as e:
             self.session.rollback()
             raise e
 
+    @contextmanager
+    def replica(self):
+        """块内的只读语句可以走从库"""
+        old = getattr(g, 'db_replica', False)
+        g.db_replica = True
+        try:
+            yield
+        finally:
+            g.db_replica = old
+
+    def sticky(self) -> bool:
+        """该用户最近写过，读走主库，每个请求只查一次redis"""
+        if (sticky := getattr(g, 'db_sticky', None)) is None:
+            user_id = getattr(g, 'user_id', None)
+            sticky = g.db_sticky = bool(user_id and redis_cli.exists(f'db-sticky-{user_id}'))
+        return sticky
+
+    def stick(self):
+        """提交之后调用，没有配置从库就不用记"""
+        if db_replica_uri and db_sticky and (user_id := getattr(g, 'user_id', None)):
+            redis_cli.set(f'db-sticky-{user_id}', 1, ex=db_sticky)
+            g.db_sticky = True
+
+    def executor(self, sql: str):
+        """
+        写语句或者已经写过之后走session的事务，在after_request里提交
+        之前的只读语句走autocommit连接，没有begin、commit的往返
+        声明了走从库的dao方法，没有写过也不在粘滞期内就走从库
+        """
+        if getattr(g, 'db_write', False) or is_write(sql):
+            g.db_write = g.db_commit = True
+            return self.session
+        if getattr(g, 'db_replica', False) and 'replica' in self.engines and not self.sticky():
+            key, engine = 'db_read_replica', self.engines['replica']
+        else:
+            key, engine = 'db_read', self.engine
+        if (conn := getattr(g, key, None)) is None:
+            conn = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+            setattr(g, key, conn)
+        return conn
+
+    @staticmethod
+    def close_read(e: Optional[BaseException] = None):
+        for key in ('db_read', 'db_read_replica'):
+            if (conn := g.pop(key, None)) is not None:
+                conn.close()
+
+    def count_commit(self, endpoint: Optional[str], commit: bool):
+        stats = self.commit_stats.setdefault(endpoint or '', {'commit': 0, 'skip': 0})
+        stats['commit' if commit else 'skip'] += 1
+
     def execute(self, sql: str, **kwargs) -> Optional[Tuple[RMKeyView, Any]]:
-        g.db_commit = True
-        log.info(text(sql))
-        response = self.session.execute(text(sql), kwargs)
+        log.info(sql)
+        return self.fetch(self.executor(sql).execute(_text(sql), kwargs))
+
+    def execute_prepared(self, sql: str, **kwargs) -> Optional[Tuple[RMKeyView, Any]]:
+        """
+        服务端预编译，热点查询用，省掉每次的解析和规划
+        预编译语句跟着数据库连接走，按连接记录已经prepare过的语句名
+        走pgbouncer事务模式时要在配置里关掉
+        """
+        if not db_prepare:
+            return self.execute(sql, **kwargs)
+        name, prepare, execute = _prepare(sql)
+        conn = self.executor(sql)
+        dbapi_conn = (conn.connection() if conn is self.session else conn).connection
+        prepared = dbapi_conn.info.setdefault('prepared', set())
+        if name not in prepared:
+            log.info(f'prepare {name}: {sql}')
+            conn.execute(prepare)
+            prepared.add(name)
+        log.info(f'execute {name}')
+        return self.fetch(conn.execute(execute, kwargs))
+
+    @staticmethod
+    def fetch(response) -> Optional[Tuple[RMKeyView, Any]]:
         if response.returns_rows:
             records = response.fetchall()
             log.info(str(records))
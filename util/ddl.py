@@ -90,6 +90,8 @@ pictures text[] not null,
 ico_name text not null,
 dead_line timestamp,
 extend3 text,
+city_code int8,
+district_code int8,
 unique(location)
 );
 
@@ -97,6 +99,15 @@ unique(location)
 CREATE INDEX type_index ON flag(type);
 create index flag_user_id_index on flag using hash(user_id);
 CREATE INDEX flag_location_index ON flag USING GIST (location);
+CREATE INDEX flag_city_code_index ON flag(city_code);
+CREATE INDEX flag_district_code_index ON flag(district_code, type);
+'''
+
+# flag表增加所属市、区县code，存量数据由AutoClean.backfill_flag_region回填，国外为0
+'''
+alter table flag add column city_code int8, add column district_code int8;
+CREATE INDEX flag_city_code_index ON flag(city_code);
+CREATE INDEX flag_district_code_index ON flag(district_code, type);
 '''
 
 # 评论表
@@ -177,11 +188,23 @@ create_time timestamp
 )
 '''
 
-# 标记统计表，hstore类型一定不能为null，null会导致所有函数的返回值都是null而非布尔值，可以为空字串
+# 标记删除日志，地图增量同步用
+d11 = '''
+create table flag_delete_log (
+flag_id uuid primary key,
+location geometry(geometry,4326) not null,
+type int not null,
+delete_time timestamp not null
+);
+
+CREATE INDEX flag_delete_log_time_index ON flag_delete_log(delete_time);
+CREATE INDEX flag_delete_log_location_index ON flag_delete_log USING GIST (location);
+'''
+
+# 标记统计表，点赞用户在flag_like表，这里只保留计数器
 '''
 create table flag_statistics(
 flag_id uuid not null primary key,
-like_users hstore not null default '',
 like_num int not null default 0,
 fav_num int not null default 0,
 comment_num int not null default 0,
@@ -201,17 +224,29 @@ update_time timestamp not null
 CREATE INDEX app_illuminate_adcode_index on app_illuminate (code);
 
 insert into app_illuminate(code, city, location, flag_num, update_time)
-with s1 as (select a.code, a.name, a.center location, f.fence from adcode a inner join fences f on a.adcode=f.adcode 
-where "rank"=2 and not virtual) 
-select s1.code, s1.name city, s1.location, count(f.id) flag_num, current_timestamp update_time from flag f 
-right join s1 on ST_Contains(s1.fence,f.location) group by s1.code, s1.name,s1.location;
+select a.code, a.name city, a.center location, count(f.id) flag_num, current_timestamp update_time from adcode a
+left join flag f on f.city_code=a.code
+where a.rank=2 and not a.virtual and exists(select 1 from fences e where e.adcode=a.adcode)
+group by a.code, a.name, a.center;
 
 insert into app_illuminate(code, city, location, flag_num, update_time)
-with s1 as (select a.code, a.name, f.fence from adcode a inner join fences f on a.adcode=f.adcode 
-where "rank"=2 and not virtual) 
-select 0 code, '国外' city, 'SRID=4326;point (0 0)' location, count(f.id) flag_num, current_timestamp update_time 
-from flag f 
-left join s1 on ST_Contains(s1.fence,f.location)  group by s1.code, s1.name having s1.code is null and s1.name is null;
+select 0 code, '国外' city, 'SRID=4326;point (0 0)' location, count(id) flag_num, current_timestamp update_time
+from flag where city_code=0;
+'''
+
+# 区县标记计数，标记增删改时同事务更新，每晚按flag.district_code校准
+'''
+create table region_flag_count (
+code int8 not null,
+type int not null,
+flag_num int not null default 0,
+update_time timestamp not null,
+primary key(code, type)
+);
+
+insert into region_flag_count(code, type, flag_num, update_time)
+select district_code, type, count(id) flag_num, current_timestamp update_time from flag
+where district_code!=0 group by district_code, type;
 '''
 
 # 标记点赞表
@@ -224,6 +259,17 @@ PRIMARY KEY (flag_id, user_id)
 )
 '''
 
+# 点赞从flag_statistics.like_users迁移到flag_like，迁移后按实际点赞数校准like_num
+'''
+insert into flag_like (flag_id, user_id, update_time)
+select flag_id, skeys(like_users)::uuid, update_time from flag_statistics
+on conflict do nothing;
+
+update flag_statistics s set like_num=coalesce((select count(*) from flag_like l where l.flag_id=s.flag_id), 0);
+
+alter table flag_statistics drop column like_users;
+'''
+
 # 评论点赞表
 '''
 create table flag_comment_like (
@@ -1,12 +1,17 @@
 r"""
 本文件的id类型声明为uuid，但是实际是str类型
 """
+import atexit
 import logging
+import os
 import pickle
 from functools import wraps
-from time import sleep
-from typing import Callable
+from queue import Queue, Full, Empty
+from threading import Lock, Thread
+from time import sleep, time
+from typing import Callable, List, Optional, Set, Tuple, Union
 import pika
+from pika.adapters.blocking_connection import BlockingChannel
 from util import config
 
 
@@ -27,16 +32,136 @@ def cb_log(func):
     return f
 
 
+def connect() -> BlockingChannel:
+    """创建连接和通道"""
+    user_info = pika.PlainCredentials(**config.mq_auth)  # 用户名和密码
+    return pika.BlockingConnection(pika.ConnectionParameters(credentials=user_info, **config.mq_conn)).channel()
+
+
+class MqPublisher:
+    """
+    发布端，pika的连接不是线程安全的，每个进程一个后台线程独占连接发布
+    请求线程只往有界队列里放，不等broker，队列满了put返回False，由调用方决定怎么处理
+    一次取出一批放在一个事务里发布，tx_commit返回即broker确认了整批，一批只有一次往返
+    失败的整批留着，指数退避重连后重发，确认丢失的那批会重复投递
+    第一次发布时才启动线程，避免fork前起线程，进程退出前最多等drain_timeout秒发完
+    @:param max_size    队列长度
+    @:param batch       每批最多发布条数
+    @:param max_backoff 重连最长等待秒数
+    @:param drain_timeout 进程退出前等待发完的秒数
+    """
+
+    def __init__(self, max_size: int = 10000, batch: int = 200, max_backoff: float = 30, drain_timeout: float = 3):
+        self.max_size = max_size
+        self.batch = batch
+        self.max_backoff = max_backoff
+        self.drain_timeout = drain_timeout
+        self.lock = Lock()
+        self.pid = None
+        self.queue: Optional[Queue] = None
+        self.dropped = 0
+
+    def ensure(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            # fork出来的进程不能用父进程的队列和连接
+            self.queue = Queue(self.max_size)
+            Thread(target=self.run, name='mq-publisher', daemon=True).start()
+            atexit.register(self.drain)
+            self.pid = os.getpid()
+
+    def put(self, queue_name: str, body: Union[str, bytes]) -> bool:
+        """队列满了返回False"""
+        self.ensure()
+        try:
+            self.queue.put_nowait((queue_name, body))
+            return True
+        except Full:
+            self.dropped += 1
+            log.error(f'put {queue_name}: publisher queue full, dropped {self.dropped}')
+            return False
+
+    def drain(self):
+        """进程退出前等后台线程把队列里的和正在发的发完"""
+        if self.pid != os.getpid():
+            return
+        deadline = time() + self.drain_timeout
+        while self.queue.unfinished_tasks and time() < deadline:
+            sleep(0.05)
+        if left := self.queue.unfinished_tasks:
+            log.error(f'publisher exit: {left} messages lost')
+
+    def take(self, timeout: float = 5) -> List[Tuple[str, bytes]]:
+        """等到第一条，再把队列里现有的取出来凑一批，超时返回空"""
+        try:
+            pending = [self.queue.get(timeout=timeout)]
+        except Empty:
+            return []
+        while len(pending) < self.batch:
+            try:
+                pending.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return pending
+
+    def run(self):
+        channel: Optional[BlockingChannel] = None
+        declared: Set[str] = set()
+        pending: List[Tuple[str, bytes]] = []
+        backoff = 0.5
+        while True:
+            if not pending and not (pending := self.take()):
+                # 空闲时也要处理心跳，不然broker会断开连接
+                if channel is not None and channel.is_open:
+                    try:
+                        channel.connection.process_data_events(time_limit=0)
+                    except Exception as e:
+                        log.error(f'publisher heartbeat: {e}')
+                        channel = None
+                continue
+            try:
+                if channel is None or channel.is_closed:
+                    channel = connect()
+                    channel.tx_select()
+                    declared.clear()
+                for queue_name in {i[0] for i in pending} - declared:
+                    channel.queue_declare(queue=queue_name)
+                    declared.add(queue_name)
+                for queue_name, body in pending:
+                    channel.basic_publish(exchange='', routing_key=queue_name, body=body)
+                # 提交之前出错整批都不会投递，留着重发
+                channel.tx_commit()
+                for _ in pending:
+                    self.queue.task_done()
+                pending = []
+                backoff = 0.5
+            except Exception as e:
+                log.error(f'publish: {e}, pending {len(pending)}, retry in {backoff}s')
+                try:
+                    if channel is not None and channel.is_open:
+                        channel.connection.close()
+                except Exception:
+                    pass
+                channel = None
+                sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+
+publisher = MqPublisher()
+
+
 class MqBase:
     queue_name: ''
     cb: Callable
+    channel: BlockingChannel
 
-    def __init__(self):
+    def connect(self):
+        """消费端自己的连接，只在slave的消费线程里用"""
         try:
-            # 创建连接和通道
-            user_info = pika.PlainCredentials(**config.mq_auth)  # 用户名和密码
-            self.channel = pika.BlockingConnection(pika.ConnectionParameters(
-                credentials=user_info, **config.mq_conn)).channel()
+            self.channel = connect()
             # 声明队列
             self.channel.queue_declare(queue=self.queue_name)
         except Exception as e:
@@ -45,24 +170,19 @@ class MqBase:
     def register_cb(self, func: Callable):
         self.cb = func
 
-    def put(self, body: str):
-        """通过ip获取为详细位置"""
+    def put(self, body: Union[str, bytes]) -> bool:
+        """交给后台线程发布，不阻塞请求，发布队列满了返回False"""
         log.info(f'put {self.queue_name} mq: {body}')
-        try:
-            self.channel.basic_publish(exchange='', routing_key=self.queue_name, body=body)
-        except Exception as e:
-            log.error(f'put {self.queue_name}: {e}')
-            self.__init__()
-            self.channel.basic_publish(exchange='', routing_key=self.queue_name, body=body)
+        return publisher.put(self.queue_name, body)
 
     def loop(self):
-        self.channel.basic_consume(self.queue_name, self.callback, auto_ack=True)
         while True:
             try:
+                self.connect()
+                self.channel.basic_consume(self.queue_name, self.callback, auto_ack=True)
                 self.channel.start_consuming()
             except Exception as e:
                 log.error(f'loop {self.queue_name}: {e}')
-                self.__init__()
             finally:
                 sleep(1)
 
@@ -0,0 +1,132 @@
+r"""
+slave本地预写日志，mq是auto_ack，内存里还没写库的事件进程一挂就没了
+每个事件先追加到日志再进缓冲区，后台线程批量fsync，写库成功后删掉对应的段，启动时回放没删掉的段
+一个段对应一个缓冲区：交换缓冲区时同时换段
+记录格式：4字节长度 + 4字节crc32 + 数据，尾部写了一半的记录回放时丢掉
+"""
+import logging
+import os
+import struct
+from threading import Lock, Thread
+from time import sleep, time
+from typing import Iterator, List
+from zlib import crc32
+
+from util.config import wal_dir
+
+log = logging.getLogger(__name__)
+
+
+class WriteAheadLog:
+    """
+    @:param name            日志名，目录下段文件的前缀
+    @:param sync_interval   fsync间隔，文件不带缓冲，进程崩溃不丢，机器掉电最多丢这么久的事件
+    """
+    header = struct.Struct('!II')
+
+    def __init__(self, name: str, sync_interval: float = 0.2):
+        self.name = name
+        self.sync_interval = sync_interval
+        self.lock = Lock()
+        self.seq = 0
+        self.file = None
+        self.dirty = False
+        os.makedirs(wal_dir, exist_ok=True)
+
+    def path(self, seq: int) -> str:
+        return os.path.join(wal_dir, f'{self.name}.{seq:012d}.wal')
+
+    def segments(self) -> List[int]:
+        prefix, suffix = f'{self.name}.', '.wal'
+        return sorted(int(f[len(prefix):-len(suffix)]) for f in os.listdir(wal_dir)
+                      if f.startswith(prefix) and f.endswith(suffix))
+
+    def open(self) -> List[int]:
+        """打开新段开始记录，返回上次进程留下的旧段，回放完调用drop"""
+        old = self.segments()
+        with self.lock:
+            self.seq = old[-1] + 1 if old else 0
+            self.file = open(self.path(self.seq), 'ab', buffering=0)
+        Thread(target=self.sync_loop, name=f'{self.name}-wal-sync', daemon=True).start()
+        return old
+
+    def append(self, data: bytes):
+        with self.lock:
+            self.file.write(self.header.pack(len(data), crc32(data)) + data)
+            self.dirty = True
+
+    def sync(self):
+        # fsync在锁内做，换段关文件不会和它撞上，代价是每次fsync期间追加会等一下
+        with self.lock:
+            if not self.dirty:
+                return
+            os.fsync(self.file.fileno())
+            self.dirty = False
+
+    def rotate(self) -> int:
+        """换新段，返回旧段序号，要在交换缓冲区的同一把锁里调用"""
+        with self.lock:
+            os.fsync(self.file.fileno())
+            self.file.close()
+            seq, self.seq = self.seq, self.seq + 1
+            self.file = open(self.path(self.seq), 'ab', buffering=0)
+            self.dirty = False
+            return seq
+
+    def drop(self, *seqs: int):
+        """对应的数据已经写库，删除段"""
+        for seq in seqs:
+            try:
+                os.remove(self.path(seq))
+            except FileNotFoundError:
+                pass
+
+    def quarantine(self, seq: int):
+        """数据本身有问题写不进库的段，改名留着人工处理，不再回放"""
+        try:
+            os.rename(self.path(seq), self.path(seq)[:-len('.wal')] + '.dead')
+        except FileNotFoundError:
+            pass
+
+    def read(self, seq: int) -> Iterator[bytes]:
+        with open(self.path(seq), 'rb') as f:
+            while len(head := f.read(self.header.size)) == self.header.size:
+                size, crc = self.header.unpack(head)
+                data = f.read(size)
+                if len(data) != size or crc32(data) != crc:
+                    log.warning(f'wal {self.name} segment {seq} truncated')
+                    return
+                yield data
+
+    def sync_loop(self):
+        while True:
+            sleep(self.sync_interval)
+            try:
+                self.sync()
+            except Exception as e:
+                log.exception(e)
+
+
+class Backoff:
+    """
+    写库失败后的退避，期间flush直接跳过
+    @:param base    第一次失败后的等待秒数
+    @:param cap     最长等待秒数
+    """
+
+    def __init__(self, base: float = 1, cap: float = 60):
+        self.base = base
+        self.cap = cap
+        self.delay = 0
+        self.retry_at = 0
+
+    def ready(self) -> bool:
+        return time() >= self.retry_at
+
+    def fail(self) -> float:
+        self.delay = min(max(self.delay * 2, self.base), self.cap)
+        self.retry_at = time() + self.delay
+        return self.delay
+
+    def reset(self):
+        self.delay = self.retry_at = 0